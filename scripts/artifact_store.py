@@ -0,0 +1,186 @@
+"""
+Versioned on disk store for the arrays the recommender serves from
+
+An artifact directory holds plain .npy files that are opened with numpy's mmap_mode so start up
+does not read them into memory and several processes share the same page cache, plus a small
+manifest.json describing them:
+
+    <model file>.artifacts/
+        manifest.json
+        doc_topics.npy       float32 (documents, topics) model output
+        unit_topics.npy      float32 (documents, topics) row normalized doc_topics
+        ids.npy              int64 (documents,) gutenberg ids in corpus order
+        corpus_indptr.npy    \
+        corpus_indices.npy    > CSR components of the (documents, terms) bag of words corpus
+        corpus_data.npy      /
+        tfidf_indptr.npy     \
+        tfidf_indices.npy     > (optional) CSR components of the row normalized tf-idf corpus, added
+        tfidf_data.npy       /  the first time hybrid recommendations are asked for
+"""
+
+
+import hashlib
+import json
+import os
+import os.path as path
+
+import numpy as np
+from scipy import sparse
+
+ARTIFACT_VERSION = 1
+MANIFEST = 'manifest.json'
+ARTIFACT_SUFFIX = '.artifacts'
+
+
+def artifact_dir(model_path: str):
+    """
+    the artifact directory that belongs to a model file
+    :param model_path: location of the saved model
+    :return: path of the artifact directory
+    """
+    return model_path + ARTIFACT_SUFFIX
+
+
+def model_hash(model_path: str, chunk_size: int = 1 << 20):
+    """
+    sha1 of the model file, used to tie artifacts to the exact model that produced them
+    :param model_path: location of the saved model
+    :param chunk_size: bytes to read at a time
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    with open(model_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_artifacts(directory: str, model_path: str, arrays: dict, corpus=None, **extra):
+    """
+    writes arrays and the manifest.  The manifest is written last (and atomically) so a directory
+    with a manifest is always complete
+    :param directory: artifact directory to write to
+    :param model_path: location of the model the arrays came from
+    :param arrays: dictionary of name to numpy array
+    :param corpus: (optional) scipy sparse (documents, terms) matrix, stored as CSR components
+    :param extra: extra json serializable values to record in the manifest
+    :return: the manifest dictionary
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = path.join(directory, MANIFEST)
+    if path.isfile(manifest_path):
+        os.remove(manifest_path)
+    arrays = dict(arrays)
+    if corpus is not None:
+        corpus = sparse.csr_matrix(corpus)
+        arrays.update(corpus_indptr=corpus.indptr, corpus_indices=corpus.indices,
+                      corpus_data=corpus.data)
+        extra['corpus_shape'] = list(corpus.shape)
+    _save_arrays(directory, arrays)
+
+    manifest = {'version': ARTIFACT_VERSION,
+                'model_file': path.basename(model_path),
+                'model_hash': model_hash(model_path),
+                'arrays': {name: _describe(array) for name, array in arrays.items()}}
+    manifest.update(extra)
+    _write_manifest(directory, manifest)
+    return manifest
+
+
+def add_artifacts(directory: str, manifest: dict, arrays: dict):
+    """
+    adds arrays derived from the existing ones to an artifact directory, everything already in it
+    is kept.  As in save_artifacts the manifest is rewritten last
+    :param directory: artifact directory
+    :param manifest: current manifest dictionary
+    :param arrays: dictionary of name to numpy array
+    :return: the new manifest dictionary
+    """
+    _save_arrays(directory, arrays)
+    manifest = dict(manifest)
+    manifest['arrays'] = dict(manifest['arrays'],
+                              **{name: _describe(array) for name, array in arrays.items()})
+    _write_manifest(directory, manifest)
+    return manifest
+
+
+def load_manifest(directory: str):
+    """
+    reads the manifest of an artifact directory
+    :param directory: artifact directory
+    :return: manifest dictionary or None if there is no readable manifest of the current version
+    """
+    try:
+        with open(path.join(directory, MANIFEST)) as fp:
+            manifest = json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get('version') != ARTIFACT_VERSION:
+        return None
+    return manifest
+
+
+def artifacts_current(directory: str, model_path: str):
+    """
+    checks whether the artifact directory was built from this exact model file
+    :param directory: artifact directory
+    :param model_path: location of the saved model
+    :return: boolean
+    """
+    manifest = load_manifest(directory)
+    return manifest is not None and manifest['model_hash'] == model_hash(model_path)
+
+
+def load_artifacts(directory: str, names=None, mmap_mode: str = 'r'):
+    """
+    opens the arrays of an artifact directory without reading them into memory
+    :param directory: artifact directory
+    :param names: (optional) names of the arrays to open, defaults to all of them
+    :param mmap_mode: passed to np.load, None reads the arrays into memory
+    :return: manifest dictionary, dictionary of name to (memory mapped) array
+    """
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f'no version {ARTIFACT_VERSION} artifacts in {directory}')
+    if names is None:
+        names = manifest['arrays']
+    arrays = {}
+    for name in names:
+        arrays[name] = np.load(path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+        expected = manifest['arrays'][name]
+        if list(arrays[name].shape) != expected['shape'] or \
+                str(arrays[name].dtype) != expected['dtype']:
+            raise ValueError(f'{name} in {directory} does not match its manifest entry')
+    return manifest, arrays
+
+
+def load_corpus_matrix(manifest: dict, arrays: dict, name: str = 'corpus'):
+    """
+    rebuilds the sparse corpus from its CSR components without copying them
+    :param manifest: manifest dictionary
+    :param arrays: dictionary of arrays holding the corpus components
+    :param name: prefix of the components, e.g. tfidf for the tf-idf weighted corpus
+    :return: scipy sparse csr matrix of shape (documents, terms)
+    """
+    return sparse.csr_matrix((arrays[f'{name}_data'], arrays[f'{name}_indices'],
+                              arrays[f'{name}_indptr']), shape=manifest['corpus_shape'], copy=False)
+
+
+def _save_arrays(directory, arrays):
+    for name, array in arrays.items():
+        # written under a temporary name and renamed so processes that still have the old array
+        # memory mapped keep reading the old file instead of one being overwritten under them
+        temp_path = path.join(directory, name + '.tmp.npy')
+        np.save(temp_path, array)
+        os.replace(temp_path, path.join(directory, name + '.npy'))
+
+
+def _describe(array):
+    return {'shape': list(array.shape), 'dtype': str(array.dtype)}
+
+
+def _write_manifest(directory: str, manifest: dict):
+    temp_path = path.join(directory, MANIFEST + '.tmp')
+    with open(temp_path, 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(temp_path, path.join(directory, MANIFEST))
@@ -0,0 +1,140 @@
+"""
+Non interactive recommendations for many seed books at once
+
+Precomputes "readers also liked" lists: the seed books are scored against the whole catalogue a
+block at a time with one matrix multiplication per block.  The block size is chosen so the block's
+score matrix stays under a memory budget, and each block's results are written out before the next
+block is scored.
+
+    $ python batch_recommender.py <file of gutenberg ids, or all> <k> <output .csv or .parquet>
+"""
+
+
+import csv
+import logging
+from sys import argv
+
+import numpy as np
+
+from neighbours import top_k_rows
+from recommender import load_resources
+
+_FIELDS = ['book_id', 'rank', 'recommendation_id', 'similarity']
+
+
+def batch_recommend(book_ids, k, output_path, resources=None, memory_budget=256 * 2 ** 20):
+    """
+    computes the top k recommendations of every seed book and streams them to a file
+    :param book_ids: gutenberg ids to recommend from, None for the entire catalogue
+    :param k: number of recommendations per book
+    :param output_path: .csv or .parquet file to write, one row per (book, recommendation)
+    :param resources: (optional) output of recommender.load_resources, in hybrid mode the shortlist
+                      of every seed is reranked and the similarity written is the blended score
+    :param memory_budget: bytes the scoring of one block may use, see _bytes_per_seed
+    :return: number of seed books written
+    """
+    if not resources:
+        resources = load_resources(serving_only=True)
+    model, corpus, ids, pg_id_to_ind, doc_topics, ann_index, reranker = resources
+    if book_ids is None:
+        seeds = np.arange(len(ids))
+    else:
+        missing = [book_id for book_id in book_ids if book_id not in pg_id_to_ind]
+        if missing:
+            logging.warning(f'{len(missing)} ids are not in the corpus and are skipped: '
+                            f'{missing[:10]}')
+        seeds = np.array([pg_id_to_ind[book_id] for book_id in book_ids
+                          if book_id in pg_id_to_ind], dtype=np.int64)
+    block_size = max(1, memory_budget // _bytes_per_seed(doc_topics, k, reranker))
+
+    with _BlockWriter(output_path) as write_block:
+        for start in range(0, len(seeds), block_size):
+            block = seeds[start:start + block_size]
+            scores = doc_topics[block] @ doc_topics.T
+            if reranker is None:
+                rec_ind, similarity = top_k_rows(scores, k, exclude=block)
+            else:
+                shortlists, _ = top_k_rows(scores, max(reranker.shortlist, k), exclude=block)
+                rec_ind, similarity = _rerank_block(reranker, block, shortlists, doc_topics, k)
+            write_block(ids[block], ids[rec_ind], similarity)
+            logging.debug(f'{start + len(block)} of {len(seeds)} books done')
+    return len(seeds)
+
+
+def _bytes_per_seed(doc_topics, k, reranker=None):
+    # a row of scores and a row of argpartition's int64 indices, then for every candidate kept its
+    # index, score and sort order and the sorted index and score.  In hybrid mode the reranked
+    # int64 index and float64 score of every seed are stacked, and reranking a seed's shortlist
+    # takes the candidates' topic rows and three float64 score arrays (counted per seed so the
+    # estimate stays an upper bound)
+    num_docs, num_topics = doc_topics.shape
+    itemsize = doc_topics.dtype.itemsize
+    num_candidates = k if reranker is None else max(reranker.shortlist, k)
+    per_seed = num_docs * (itemsize + 8) + num_candidates * (3 * 8 + 2 * itemsize)
+    if reranker is not None:
+        per_seed += k * (8 + 8) + num_candidates * (num_topics * itemsize + 3 * 8)
+    return per_seed
+
+
+def _rerank_block(reranker, block, shortlists, doc_topics, k):
+    # hybrid mode, each seed's topic shortlist is reranked on its own (see neighbours.TfidfReranker)
+    reranked = [reranker.rerank(shortlist, doc_topics[seed], doc_topics,
+                                reranker.query_vector([seed]), k)
+                for seed, shortlist in zip(block, shortlists)]
+    rec_ind, similarity = zip(*reranked)
+    return np.stack(rec_ind), np.stack(similarity)
+
+
+def read_ids(file_path):
+    """
+    reads a file with one gutenberg id per line, blank lines are ignored
+    :param file_path: location of the file
+    :return: list of gutenberg ids
+    """
+    with open(file_path) as fp:
+        return [int(line) for line in fp if line.strip()]
+
+
+class _BlockWriter:
+    """
+    context manager that hands out a function writing one block of results, to csv with the
+    standard library or to parquet with pyarrow (imported only when needed)
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.parquet = output_path.endswith('.parquet')
+        self.fp = self.writer = None
+
+    def __enter__(self):
+        if not self.parquet:
+            self.fp = open(self.output_path, 'w', newline='')
+            self.writer = csv.writer(self.fp)
+            self.writer.writerow(_FIELDS)
+        return self.write_block
+
+    def write_block(self, book_ids, rec_ids, similarity):
+        num_recs = rec_ids.shape[1]
+        ranks = np.tile(np.arange(1, num_recs + 1), len(book_ids))
+        columns = [np.repeat(book_ids, num_recs), ranks, rec_ids.ravel(), similarity.ravel()]
+        if not self.parquet:
+            self.writer.writerows(zip(*[column.tolist() for column in columns]))
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.table(dict(zip(_FIELDS, columns)))
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_path, table.schema)
+        self.writer.write_table(table)
+
+    def __exit__(self, *exc_info):
+        if self.fp is not None:
+            self.fp.close()
+        elif self.writer is not None:
+            self.writer.close()
+
+
+if __name__ == '__main__':
+    seed_ids = None if argv[1] == 'all' else read_ids(argv[1])
+    batch_recommend(seed_ids, int(argv[2]), argv[3])
@@ -0,0 +1,264 @@
+"""
+Benchmarks for the hot paths of the pipeline
+
+Everything runs on synthetic Gutenberg-like text so the numbers can be reproduced without the
+corpus.
+    $ python benchmark.py tokenizers <megabytes>
+    $ python benchmark.py pipeline [number of documents ...]
+
+The pipeline benchmark times every stage from raw text to recommendations for each corpus size
+(1k, 10k and 50k documents by default).  Each size runs in a fresh process so its peak resident
+memory is not inflated by the sizes before it.
+"""
+
+
+import json
+import os.path as path
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from sys import argv
+
+import numpy as np
+
+import recommender
+from lda_topic_modeling import convert_corpus, fit_lda, fit_vectorizer
+from pre_processing import create_gist, fast_pre_processing, gist_pre_processing
+
+_COMMON_WORDS = ['the', 'and', 'of', 'to', 'a', 'in', 'that', 'he', 'was', 'it', 'his', 'i',
+                 'with', 'as', 'had', 'for', 'you', 'her', 'she', 'not', 'but', 'said', "don't",
+                 "it's", "i'm", "can't", "o'clock", "'tis", 'cannot', 'gonna', 'mr', 'mrs']
+_PUNCTUATION = ['', ',', '.', ';', '!', '?', ':', '—', '"', "'"]
+_PUNCTUATION_WEIGHTS = [.798, .08, .06, .01, .008, .008, .004, .005, .022, .005]
+
+
+def synthetic_text(num_bytes: int, vocab_size: int = 20000, seed: int = 0):
+    """
+    generates prose-like text with a zipfian vocabulary, common contractions, punctuation, numbers
+    and line breaks every ~70 characters like the gutenberg plain text files
+    :param num_bytes: approximate length of the text
+    :param vocab_size: number of distinct made up words
+    :param seed: random seed
+    :return: string
+    """
+    rng = np.random.default_rng(seed)
+    vocab = _COMMON_WORDS + _made_up_words(vocab_size, rng)
+    weights = _zipf_weights(len(vocab))
+
+    num_words = num_bytes // 6
+    words = rng.choice(len(vocab), num_words, p=weights)
+    marks = rng.choice(len(_PUNCTUATION), num_words, p=_PUNCTUATION_WEIGHTS)
+    capitals = rng.random(num_words) < .05
+    numbers = rng.random(num_words) < .002
+    pieces = []
+    line_length = 0
+    for word, mark, capital, number in zip(words, marks, capitals, numbers):
+        token = str(rng.integers(1, 2000)) if number else vocab[word]
+        if capital:
+            token = token.capitalize()
+        token += _PUNCTUATION[mark]
+        line_length += len(token) + 1
+        if line_length > 70:
+            pieces.append('\n')
+            line_length = 0
+        pieces.append(token + ' ')
+    return ''.join(pieces)
+
+
+def synthetic_gists(num_docs: int, words_per_doc: int = 500, num_topics: int = 20,
+                    vocab_size: int = 20000, seed: int = 0):
+    """
+    generates gist-like documents with real topic structure so lda has something to find.  Every
+    topic ranks the vocabulary in its own random order and draws words zipfian by that rank, every
+    document draws its topic mixture from a sparse dirichlet
+    :param num_docs: number of documents
+    :param words_per_doc: words in each document
+    :param num_topics: number of topics the documents are drawn from
+    :param vocab_size: number of distinct made up words
+    :param seed: random seed
+    :return: list of strings
+    """
+    rng = np.random.default_rng(seed)
+    vocab = np.array(_made_up_words(vocab_size, rng))
+    topic_words = np.array([rng.permutation(vocab_size) for _ in range(num_topics)])
+    rank_cdf = np.cumsum(_zipf_weights(vocab_size))
+    rank_cdf[-1] = 1
+    gists = []
+    for _ in range(num_docs):
+        mixture = rng.dirichlet(np.full(num_topics, .1))
+        topics = rng.choice(num_topics, words_per_doc, p=mixture)
+        ranks = np.searchsorted(rank_cdf, rng.random(words_per_doc))
+        gists.append(' '.join(vocab[topic_words[topics, ranks]]))
+    return gists
+
+
+def _made_up_words(vocab_size, rng):
+    letters = np.array(list('etaoinshrdlcumwfgypbvkjxqz'))
+    letter_weights = _zipf_weights(len(letters))
+    lengths = rng.integers(3, 11, vocab_size)
+    return [''.join(rng.choice(letters, length, p=letter_weights)) for length in lengths]
+
+
+def _zipf_weights(size):
+    weights = 1 / np.arange(1, size + 1)
+    return weights / weights.sum()
+
+
+def time_call(func, *args, repeats: int = 3):
+    """
+    times a function call, best of several repeats
+    :param func: function to time
+    :param args: arguments for the function
+    :param repeats: number of times to call it
+    :return: fastest time in seconds, result of the last call
+    """
+    best = float('inf')
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_tokenizers(megabytes: float = 1, repeats: int = 3):
+    """
+    compares the nltk and fast gist tokenizers on the same synthetic text
+    :param megabytes: size of the text to tokenize
+    :param repeats: timing repeats, the fastest is kept
+    :return: dictionary of results
+    """
+    text = synthetic_text(int(megabytes * 1e6))
+    size = len(text.encode()) / 1e6
+    results = {'megabytes': size}
+    tokens = {}
+    for name, func in [('nltk', gist_pre_processing), ('fast', fast_pre_processing)]:
+        seconds, tokens[name] = time_call(func, text, repeats=repeats)
+        results[name] = {'seconds': seconds, 'seconds_per_mb': seconds / size,
+                         'tokens': len(tokens[name])}
+    results['speedup'] = results['nltk']['seconds'] / results['fast']['seconds']
+    results['identical'] = tokens['nltk'] == tokens['fast']
+    return results
+
+
+def latency_stats(seconds, items=None, megabytes=None):
+    """
+    summarizes the timings of repeated calls
+    :param seconds: list of the seconds each call took
+    :param items: (optional) number of items processed over all calls, defaults to one per call
+    :param megabytes: (optional) megabytes processed over all calls
+    :return: dictionary of the total, p50 and p99 latency and the throughput
+    """
+    seconds = np.asarray(seconds)
+    total = float(seconds.sum())
+    stats = {'calls': len(seconds), 'total_seconds': total,
+             'p50_ms': float(np.percentile(seconds, 50) * 1000),
+             'p99_ms': float(np.percentile(seconds, 99) * 1000),
+             'items_per_second': (len(seconds) if items is None else items) / total}
+    if megabytes is not None:
+        stats['mb_per_second'] = megabytes / total
+    return stats
+
+
+def peak_rss_mb():
+    """
+    peak resident memory of this process so far
+    :return: megabytes, or None where the resource module is not available (windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def benchmark_pipeline(*sizes, num_topics: int = 20, passes: int = 1, words_per_doc: int = 500,
+                       gist_sample: int = 50, doc_bytes: int = 50000, num_queries: int = 500):
+    """
+    times the pipeline for each corpus size, every size in its own process
+    :param sizes: numbers of documents, defaults to 1k, 10k and 50k
+    :param num_topics: topics of the fit model
+    :param passes: lda training passes
+    :param words_per_doc: words in each synthetic gist
+    :param gist_sample: raw documents run through the gist functions, gisting is per document so
+                        its latency does not depend on the corpus size
+    :param doc_bytes: size of each raw document
+    :param num_queries: recommendations to time
+    :return: dictionary of the settings and the results of each size
+    """
+    sizes = [int(size) for size in sizes] or [1000, 10000, 50000]
+    settings = {'num_topics': num_topics, 'passes': passes, 'words_per_doc': words_per_doc,
+                'gist_sample': gist_sample, 'doc_bytes': doc_bytes, 'num_queries': num_queries}
+    results = {'settings': settings, 'sizes': {}}
+    for size in sizes:
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+            results['sizes'][size] = pool.submit(benchmark_size, size, **settings).result()
+    return results
+
+
+def benchmark_size(num_docs, num_topics=20, passes=1, words_per_doc=500, gist_sample=50,
+                   doc_bytes=50000, num_queries=500, seed=0):
+    """
+    times every stage of the pipeline on one synthetic corpus.  The model and its artifacts are
+    written to a temporary directory that the recommender is pointed at
+    :param num_docs: number of documents
+    :param seed: random seed, see benchmark_pipeline for the other parameters
+    :return: dictionary of stage name to its timings and the peak rss after the stage
+    """
+    results = {}
+    documents = [synthetic_text(doc_bytes, seed=seed + ind) for ind in range(gist_sample)]
+    megabytes = sum(len(document.encode()) for document in documents) / 1e6
+    for name, func in [('gist_pre_processing', gist_pre_processing),
+                       ('create_gist', create_gist)]:
+        seconds = [time_call(func, document, repeats=1)[0] for document in documents]
+        results[name] = latency_stats(seconds, megabytes=megabytes)
+        results[name]['peak_rss_mb'] = peak_rss_mb()
+
+    gists = synthetic_gists(num_docs, words_per_doc, num_topics, seed=seed)
+    fit_seconds, count_vect = time_call(fit_vectorizer, gists, repeats=1)
+    convert_seconds, (corpus, id2word) = time_call(convert_corpus, gists, count_vect, repeats=1)
+    results['fit_vectorizer'] = latency_stats([fit_seconds], items=num_docs)
+    results['convert_corpus'] = latency_stats([convert_seconds], items=num_docs)
+    for name in ('fit_vectorizer', 'convert_corpus'):
+        results[name]['peak_rss_mb'] = peak_rss_mb()
+    del gists, count_vect
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        seconds, model = time_call(fit_lda, num_topics, corpus, id2word, passes, 0, True,
+                                   model_dir, repeats=1)
+        results['fit_lda'] = latency_stats([seconds], items=num_docs)
+        results['fit_lda']['peak_rss_mb'] = peak_rss_mb()
+        del model
+
+        ids = [str(ind) for ind in range(num_docs)]
+        recommender._pickle(path.join(model_dir, recommender._CURRENT_CORPUS), corpus)
+        recommender._pickle(path.join(model_dir, recommender._CURRENT_TITLES), ids)
+        recommender._RELATIVE_DIR = model_dir
+        recommender._CURRENT_MODEL = f'lda_{num_topics}_topics.mdl'
+        recommender._METADATA_INDEX = path.join(model_dir, 'no_metadata.sqlite')
+        del corpus
+        # the first load runs the corpus through the model to build the artifacts
+        load_seconds = [time_call(recommender.load_resources, False, 0, repeats=1)[0]
+                        for _ in range(2)]
+        serving_seconds = time_call(recommender.load_resources, False, 0, False, True, repeats=1)[0]
+        results['load_resources'] = {'cold_seconds': load_seconds[0],
+                                     'warm_seconds': load_seconds[1],
+                                     'serving_only_seconds': serving_seconds,
+                                     'peak_rss_mb': peak_rss_mb()}
+
+        resources = recommender.load_resources(cache_size=0, serving_only=True)
+        queries = np.random.default_rng(seed).integers(0, num_docs, num_queries)
+        seconds = [time_call(recommender.recommend, int(book_id), 10, resources, repeats=1)[0]
+                   for book_id in queries]
+        results['recommend'] = latency_stats(seconds)
+        results['recommend']['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+if __name__ == '__main__':
+    benchmarks = {'tokenizers': benchmark_tokenizers, 'pipeline': benchmark_pipeline}
+    print(json.dumps(benchmarks[argv[1]](*[float(arg) for arg in argv[2:]]), indent=2))
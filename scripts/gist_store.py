@@ -0,0 +1,231 @@
+"""
+Columnar storage of gists
+
+A gist is a bag of (at most gist_depth distinct) words, so instead of one space joined text file
+per book the store keeps one shared vocabulary and, per book, the ids and counts of its words in a
+handful of large array files:
+
+    <store dir>/
+        store.json              number of books, terms and segments
+        vocabulary.txt          one word per line, the line number is the term id
+        titles.txt              one title (gutenberg id) per line, in store order
+        segment_00000.npz       indptr, term_ids and counts of up to segment_size books (CSR rows)
+        segment_00001.npz
+        ...
+
+store.json is written last (and atomically) whenever a segment is added, anything beyond the counts
+it records is ignored and cut off the next time the store is opened for writing.  to_corpus() turns
+the store into the same corpus fit_vectorizer/convert_corpus would build from the gist text files
+with one sparse matrix product, no text is tokenized.
+
+    $ python gist_store.py <gist text directory> <store directory>
+"""
+
+
+import json
+import logging
+import os
+import os.path as path
+from collections import Counter
+from sys import argv
+
+import numpy as np
+from gensim.matutils import Sparse2Corpus
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+_META = 'store.json'
+_VOCABULARY = 'vocabulary.txt'
+_TITLES = 'titles.txt'
+_SEGMENT = 'segment_{:05d}.npz'
+
+
+class GistStore:
+    """
+    Appendable store of gists.  Books are buffered by add() and written a segment at a time, use
+    the store as a context manager (or call flush()) so the last partial segment is written.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 10000):
+        """
+        opens the store, creating it if it does not exist
+        :param directory: store directory
+        :param segment_size: number of books per segment file
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(path.join(directory, _META)) as fp:
+                meta = json.load(fp)
+        except FileNotFoundError:
+            meta = {'num_books': 0, 'num_terms': 0, 'num_segments': 0}
+        self.num_segments = meta['num_segments']
+        self.words = _read_lines(path.join(directory, _VOCABULARY), meta['num_terms'])
+        self.book_titles = _read_lines(path.join(directory, _TITLES), meta['num_books'])
+        self.word2id = {word: term for term, word in enumerate(self.words)}
+        self.stored_titles = set(self.book_titles)
+        self.pending = []
+
+    def __len__(self):
+        return len(self.book_titles)
+
+    def __contains__(self, title):
+        return str(title) in self.stored_titles
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, title: str, counts: dict):
+        """
+        buffers a gist, a full segment is written to disk
+        :param title: title of the book (gutenberg id)
+        :param counts: dictionary (e.g. Counter of the gist tokens) of word to count
+        :return: None
+        """
+        term_ids = [self.word2id.setdefault(word, len(self.word2id)) for word in counts]
+        self.pending.append((str(title), term_ids, list(counts.values())))
+        self.stored_titles.add(str(title))
+        if len(self.pending) >= self.segment_size:
+            self.flush()
+
+    def flush(self):
+        """
+        writes the buffered gists as a new segment
+        :return: None
+        """
+        if not self.pending:
+            return
+        indptr = np.cumsum([0] + [len(term_ids) for _, term_ids, _ in self.pending])
+        term_ids = np.fromiter((term for _, ids, _ in self.pending for term in ids),
+                               dtype=np.int32, count=indptr[-1])
+        counts = np.fromiter((count for _, _, book_counts in self.pending
+                              for count in book_counts), dtype=np.int32, count=indptr[-1])
+        segment_path = path.join(self.directory, _SEGMENT.format(self.num_segments))
+        with open(segment_path + '.tmp', 'wb') as fp:
+            np.savez_compressed(fp, indptr=indptr, term_ids=term_ids, counts=counts)
+        os.replace(segment_path + '.tmp', segment_path)
+
+        new_words = list(self.word2id)[len(self.words):]
+        _append_lines(path.join(self.directory, _VOCABULARY), new_words)
+        _append_lines(path.join(self.directory, _TITLES), [title for title, _, _ in self.pending])
+        self.words.extend(new_words)
+        self.book_titles.extend(title for title, _, _ in self.pending)
+        self.num_segments += 1
+        self.pending = []
+        _write_meta(self.directory, {'num_books': len(self.book_titles),
+                                     'num_terms': len(self.words),
+                                     'num_segments': self.num_segments})
+        logging.debug(f'{len(self.book_titles)} gists stored in {self.directory}')
+
+    def titles(self):
+        """
+        :return: list of the stored titles in store order
+        """
+        return list(self.book_titles)
+
+    def iter_chunks(self):
+        """
+        :return: generator of scipy sparse CSR (books, store terms) count matrices, one per segment
+        """
+        for segment in range(self.num_segments):
+            with np.load(path.join(self.directory, _SEGMENT.format(segment))) as arrays:
+                indptr, term_ids, counts = arrays['indptr'], arrays['term_ids'], arrays['counts']
+            yield sparse.csr_matrix((counts, term_ids, indptr),
+                                    shape=(len(indptr) - 1, len(self.words)))
+
+    def to_csr(self):
+        """
+        :return: scipy sparse CSR (books, store terms) count matrix of the whole store
+        """
+        return sparse.vstack(list(self.iter_chunks()), format='csr')
+
+    def iter_gists(self):
+        """
+        the stored gists as text, for code that expects the gist files.  The words come out grouped
+        rather than in their original order, which makes no difference to a bag of words
+        :return: generator of (title, gist) tuples
+        """
+        titles = iter(self.book_titles)
+        for chunk in self.iter_chunks():
+            for ind in range(chunk.shape[0]):
+                start, end = chunk.indptr[ind], chunk.indptr[ind + 1]
+                words = (f'{self.words[term]} ' * int(count) for term, count
+                         in zip(chunk.indices[start:end], chunk.data[start:end]))
+                yield next(titles), ''.join(words).rstrip()
+
+    def to_corpus(self, **kwargs):
+        """
+        builds the corpus fit_vectorizer + convert_corpus would build from the gist text files.
+        The vectorizer's analyzer is run once per distinct word instead of over every gist, and the
+        counts are mapped onto its (sorted) vocabulary with a sparse matrix product
+        :param kwargs: passed to CountVectorizer to build the analyzer, stop_words defaults to
+                       english
+        :return: gensim Sparse2Corpus, dictionary of term id to word, list of titles
+        """
+        kwargs.setdefault('stop_words', 'english')
+        analyzer = CountVectorizer(**kwargs).build_analyzer()
+        analyzed = [Counter(analyzer(word)) for word in self.words]
+        vocabulary = sorted({token for tokens in analyzed for token in tokens})
+        token_ids = {token: term for term, token in enumerate(vocabulary)}
+        rows, columns, weights = [], [], []
+        for word_id, tokens in enumerate(analyzed):
+            for token, count in tokens.items():
+                rows.append(word_id)
+                columns.append(token_ids[token])
+                weights.append(count)
+        mapping = sparse.csr_matrix((weights, (rows, columns)),
+                                    shape=(len(self.words), len(vocabulary)))
+        doc_term = (self.to_csr() @ mapping).astype(np.int64)
+        corpus = Sparse2Corpus(doc_term.T.tocsc())
+        return corpus, dict(enumerate(vocabulary)), self.titles()
+
+
+def _read_lines(file_path, num_lines):
+    """
+    reads the first num_lines lines of a file, anything after them was left by an interrupted
+    flush and is cut off so the next flush can append
+    """
+    try:
+        with open(file_path, encoding='utf-8') as fp:
+            lines = fp.read().split('\n')[:num_lines]
+    except FileNotFoundError:
+        return []
+    if path.getsize(file_path) != sum(len(line.encode()) + 1 for line in lines):
+        _append_lines(file_path, lines, mode='w')
+    return lines
+
+
+def _append_lines(file_path, lines, mode='a'):
+    with open(file_path, mode, encoding='utf-8') as fp:
+        fp.writelines(line + '\n' for line in lines)
+
+
+def _write_meta(directory, meta):
+    meta_path = path.join(directory, _META)
+    with open(meta_path + '.tmp', 'w') as fp:
+        json.dump(meta, fp)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def convert_gist_dir(gist_dir: str, store_dir: str):
+    """
+    moves an existing directory of gist text files into a store, books already stored are skipped
+    :param gist_dir: directory of gist text files
+    :param store_dir: store directory
+    :return: GistStore
+    """
+    from pre_processing import iter_corpus  # pre_processing imports this module
+
+    with GistStore(store_dir) as store:
+        for title, gist in iter_corpus(gist_dir):
+            if title not in store:
+                store.add(title, Counter(gist.split()))
+    return store
+
+
+if __name__ == '__main__':
+    convert_gist_dir(argv[1], argv[2])
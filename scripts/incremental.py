@@ -0,0 +1,99 @@
+"""
+Incremental ingest of new books into an already trained model
+
+Instead of re-gisting, re-vectorizing and re-training everything when books are added to the
+catalogue, new books are
+ 1. gisted (only the files that have no gist yet)
+ 2. vectorized against the vocabulary of the saved model, unknown words are dropped
+ 3. run through the saved model to get their topic vectors, optionally after an online update()
+    of the model with the new books
+ 4. appended to the model's artifact directory (document topic matrix, ids and corpus)
+
+    $ python incremental.py <raw text directory> <gist directory> <model file> [--update]
+"""
+
+
+import logging
+from sys import argv
+
+import numpy as np
+from gensim.matutils import Sparse2Corpus
+from gensim.models import LdaMulticore
+from scipy import sparse
+
+from artifact_store import (artifact_dir, artifacts_current, load_artifacts, load_corpus_matrix,
+                            save_artifacts)
+from neighbours import normalize_rows
+from pre_processing import gistify, iter_corpus, iter_corpus_files
+from recommender import build_doc_topics
+from streaming_corpus import vectorize_with_vocabulary
+
+
+def ingest_new_books(raw_dir: str, gist_dir: str, model_path: str, update_model: bool = False,
+                     passes: int = 1, workers: int = None):
+    """
+    adds the books in raw_dir that the model's artifacts do not have yet
+    :param raw_dir: directory of raw (header stripped) text files
+    :param gist_dir: directory of gists, new gists are written here
+    :param model_path: location of the saved model, its artifact directory must be up to date
+    :param update_model: if True the model is updated with the new books (online lda) and saved
+                         before their topics are inferred.  Books already in the artifacts keep the
+                         topic vectors of the previous model
+    :param passes: passes over the new books when updating the model
+    :param workers: gistify worker processes
+    :return: list of the gutenberg ids that were added
+    """
+    directory = artifact_dir(model_path)
+    if not artifacts_current(directory, model_path):
+        raise FileNotFoundError(f'{directory} is missing or was built from a different model, '
+                                f'run the recommender once to build it')
+    gistify(raw_dir, gist_dir, workers)
+
+    manifest, arrays = load_artifacts(directory)
+    known = set(arrays['ids'].tolist())
+    new_titles = [title for title, _ in iter_corpus_files(gist_dir) if int(title) not in known]
+    if not new_titles:
+        logging.info('no new books to ingest')
+        return []
+    titles, texts = zip(*iter_corpus(gist_dir, ids=new_titles))
+
+    model = LdaMulticore.load(model_path)
+    num_terms = manifest['corpus_shape'][1]
+    doc_term = vectorize_with_vocabulary(texts, model.id2word, num_terms)
+    bows = Sparse2Corpus(doc_term, documents_columns=False)
+    if update_model:
+        model.update(bows, passes=passes)
+        model.save(model_path)
+    doc_topics = build_doc_topics(model, bows)
+
+    new_ids = np.array([int(title) for title in titles], dtype=np.int64)
+    append_to_artifacts(directory, model_path, manifest, arrays, new_ids, doc_topics, doc_term)
+    logging.info(f'{len(new_ids)} books added to {directory}')
+    return new_ids.tolist()
+
+
+def append_to_artifacts(directory, model_path, manifest, arrays, ids, doc_topics, doc_term):
+    """
+    rewrites the artifact directory with the new books appended to the end.  Existing books keep
+    their index so anything keyed on corpus position stays valid
+    :param directory: artifact directory
+    :param model_path: location of the saved model
+    :param manifest: current manifest dictionary
+    :param arrays: current arrays of the directory
+    :param ids: gutenberg ids of the new books
+    :param doc_topics: document topic matrix of the new books
+    :param doc_term: scipy sparse (documents, terms) matrix of the new books
+    :return: the new manifest dictionary
+    """
+    corpus = sparse.vstack([load_corpus_matrix(manifest, arrays), doc_term], format='csr')
+    all_topics = np.concatenate([arrays['doc_topics'], doc_topics])
+    extra = {key: value for key, value in manifest.items()
+             if key not in ('version', 'model_file', 'model_hash', 'arrays', 'corpus_shape')}
+    return save_artifacts(directory, model_path,
+                          {'doc_topics': all_topics, 'unit_topics': normalize_rows(all_topics),
+                           'ids': np.concatenate([arrays['ids'], ids])},
+                          corpus=corpus, **extra)
+
+
+if __name__ == '__main__':
+    ingest_new_books(*argv[1:4], update_model='--update' in argv[4:])
@@ -0,0 +1,202 @@
+"""
+One step ingest of the downloaded corpus
+
+Replaces the manual filter / unzip / move / clean_dir / strip_headers steps.  Every downloaded
+archive is streamed line by line straight out of the zip (nothing is extracted to disk), decoded by
+the encoding its name declares, header stripped (see strip_headers.strip_lines) and written to
+<text dir>/<gutenberg id>.txt as utf-8 with unix newlines.  Archives are spread over a pool of
+processes and every finished archive is recorded in a manifest so a rerun only processes archives
+that are new or have changed.
+
+    $ python ingest.py <download directory> <text directory> [workers]
+
+Gutenberg publishes a book in up to three encodings, <id>.zip (ascii), <id>-8.zip (latin-1) and
+<id>-0.zip (utf-8), only the best one of each book is used.  Other <id>-*.zip archives (the
+"odds") are skipped.
+"""
+
+
+import csv
+import io
+import logging
+import os
+import os.path as path
+import re
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from sys import argv
+from zipfile import BadZipFile, ZipFile
+
+import instrumentation
+from strip_headers import strip_lines, write_lines
+
+_ARCHIVE_PATTERN = re.compile(r'(\d+)(-[08])?\.zip', re.IGNORECASE)
+# declared encoding of each archive suffix, in order of preference
+_ENCODINGS = {'-0': 'utf-8', '-8': 'latin-1', '': 'ascii'}
+_FALLBACK_ENCODING = 'latin-1'  # decodes any bytes
+_ERROR_STATUS = 'error: '  # prefix of the status of archives that failed and are retried
+_MANIFEST_FIELDS = ['archive', 'size', 'mtime', 'book_id', 'encoding', 'output', 'bytes_in',
+                    'bytes_out', 'status']
+
+
+def ingest(download_dir: str, text_dir: str, workers: int = None,
+           manifest_path: str = '../outputs/ingest_manifest.csv', max_in_flight: int = None):
+    """
+    turns a directory of downloaded gutenberg zip archives into header stripped text files
+    :param download_dir: directory searched (recursively) for .zip archives
+    :param text_dir: directory the text files are written to
+    :param workers: number of worker processes, defaults to the number of cpus
+    :param manifest_path: csv of the processed archives, kept outside text_dir because every file
+                          in text_dir is read as a book
+    :param max_in_flight: archives submitted but not yet finished, defaults to 2 * workers
+    :return: number of archives processed by this run
+    """
+    os.makedirs(text_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    done_before = load_manifest(manifest_path)
+    to_ingest = [archive for archive in find_archives(download_dir)
+                 if done_before.get(archive) != _archive_key(archive)]
+    logging.info(f'{len(done_before)} archives already ingested, {len(to_ingest)} to ingest')
+
+    processed = 0
+    pending = set()
+    with instrumentation.stage('ingest'), ProcessPoolExecutor(workers) as pool:
+        for archive in to_ingest:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                processed += _record_finished(done, manifest_path)
+            pending.add(pool.submit(ingest_archive, archive, text_dir))
+        processed += _record_finished(wait(pending).done, manifest_path)
+    logging.info(f'{processed} archives ingested into {text_dir}')
+    return processed
+
+
+def find_archives(download_dir: str):
+    """
+    finds the archive to use for every book, when a book was downloaded in several encodings the
+    utf-8 one is preferred over latin-1 over ascii
+    :param download_dir: directory searched recursively
+    :return: list of archive paths, one per book
+    """
+    preference = list(_ENCODINGS)
+    best = {}
+    for root, _, files in os.walk(download_dir):
+        for name in files:
+            match = _ARCHIVE_PATTERN.fullmatch(name)
+            if match is None:
+                continue
+            book_id, suffix = match.group(1), match.group(2) or ''
+            rank = preference.index(suffix)
+            if book_id not in best or rank < best[book_id][0]:
+                best[book_id] = (rank, path.join(root, name))
+    return [archive for _, archive in best.values()]
+
+
+def ingest_archive(archive: str, text_dir: str):
+    """
+    converts a single archive, this is what the pool workers run.  The largest .txt member is the
+    book, it is streamed through the decoder and the header stripper into a temporary file which is
+    then renamed.  If it does not decode with its declared encoding it is streamed again as latin-1.
+    Any failure is reported in the row's status instead of raised so one broken archive does not
+    stop the ingest, archives that failed with an error are retried by the next run
+    :param archive: location of the zip archive
+    :param text_dir: directory to write the text file to
+    :return: manifest row dictionary
+    """
+    match = _ARCHIVE_PATTERN.fullmatch(path.basename(archive))
+    book_id, suffix = match.group(1), match.group(2) or ''
+    size, mtime = _archive_key(archive)
+    row = {'archive': archive, 'size': size, 'mtime': mtime, 'book_id': book_id, 'encoding': '',
+           'output': '', 'bytes_in': 0, 'bytes_out': 0, 'status': 'ok'}
+    output = path.join(text_dir, f'{book_id}.txt')
+    # dot prefixed and not ending in .txt so the corpus readers never take it for a book
+    temp_path = path.join(text_dir, f'.{book_id}.txt.tmp')
+    try:
+        with ZipFile(archive) as zipped:
+            members = [info for info in zipped.infolist() if info.filename.lower().endswith('.txt')]
+            if not members:
+                row['status'] = 'no text'
+                return row
+            member = max(members, key=lambda info: info.file_size)
+            for encoding in (_ENCODINGS[suffix], _FALLBACK_ENCODING):
+                try:
+                    _write_member(zipped, member, encoding, temp_path)
+                except UnicodeDecodeError:
+                    continue
+                break
+        os.replace(temp_path, output)
+    except BadZipFile:
+        logging.warning(f'{archive} is not a valid zip archive')
+        row['status'] = 'bad zip'
+        return row
+    except Exception as error:  # corrupt data, unsupported compression, disk errors...
+        logging.warning(f'{archive} could not be ingested: {error!r}')
+        row['status'] = f'{_ERROR_STATUS}{error!r}'
+        return row
+    finally:  # also on KeyboardInterrupt
+        if path.isfile(temp_path):
+            os.remove(temp_path)
+
+    row.update(encoding=encoding, output=output, bytes_in=member.file_size,
+               bytes_out=path.getsize(output))
+    return row
+
+
+def _write_member(zipped, member, encoding, output):
+    # universal newlines turn \r\n into \n, every line is NFC normalized
+    with zipped.open(member) as member_stream, open(output, 'w', encoding='utf-8') as fp:
+        lines = io.TextIOWrapper(member_stream, encoding)
+        write_lines(strip_lines(unicodedata.normalize('NFC', line) for line in lines), fp)
+
+
+def load_manifest(manifest_path: str):
+    """
+    reads the ingest manifest
+    :param manifest_path: location of the csv
+    :return: dictionary of archive path to (size, mtime) when it was processed, archives whose
+             last row is an error are left out so they are processed again
+    """
+    try:
+        with open(manifest_path, newline='') as fp:
+            rows = list(csv.DictReader(fp))
+    except FileNotFoundError:
+        return {}
+    processed = {row['archive']: row for row in rows}  # the last row of an archive wins
+    return {archive: (int(row['size']), int(row['mtime'])) for archive, row in processed.items()
+            if not row['status'].startswith(_ERROR_STATUS)}
+
+
+def _archive_key(archive):
+    stat = os.stat(archive)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _record_finished(futures, manifest_path):
+    rows = []
+    failure = None
+    for future in futures:
+        try:
+            rows.append(future.result())
+        except Exception as error:  # e.g. a killed worker, recorded after the finished rows
+            failure = failure or error
+    for row in rows:
+        instrumentation.count('archives')
+        instrumentation.count('bytes_in', row['bytes_in'])
+        instrumentation.count('bytes_out', row['bytes_out'])
+    new_file = not path.isfile(manifest_path)
+    manifest_dir = path.dirname(manifest_path)
+    if manifest_dir:
+        os.makedirs(manifest_dir, exist_ok=True)
+    with open(manifest_path, 'a', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=_MANIFEST_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+    if failure is not None:
+        raise failure
+    return len(rows)
+
+
+if __name__ == '__main__':
+    ingest(argv[1], argv[2], int(argv[3]) if argv[3:] else None)
@@ -0,0 +1,306 @@
+"""
+Stage level timing, counters and optional profiling for the scripts
+
+Instrumentation is off unless the GUTENBERG_METRICS environment variable names a metrics file (or
+enable() is called), and while it is off stage(), timed() and count() return straight away.
+
+    $ GUTENBERG_METRICS=../outputs/gistify_metrics.json python pre_processing.py
+
+When the run ends the file holds every stage's calls, total and max seconds and the counters
+incremented while it ran, with their rate per second of the stage.  Two optional captures:
+    GUTENBERG_PROFILE=1      cProfile of every outermost stage, written beside the metrics file as
+                             <metrics file>.<stage>.<pid>.prof (one per process, pstats can
+                             combine them)
+    GUTENBERG_TRACEMALLOC=1  tracemalloc peak of the python heap while each stage ran
+
+Worker processes record into their own process, the parent merges what they collect() (see
+pre_processing.gistify).
+"""
+
+
+import atexit
+import cProfile
+import functools
+import json
+import multiprocessing
+import os
+import os.path as path
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+_METRICS_ENV = 'GUTENBERG_METRICS'
+_PROFILE_ENV = 'GUTENBERG_PROFILE'
+_TRACEMALLOC_ENV = 'GUTENBERG_TRACEMALLOC'
+
+_config = None  # dictionary of the enable() arguments while instrumentation is on
+_pid = None
+_started = None
+_stages = {}
+_counters = Counter()
+_profiles = {}
+_lock = threading.Lock()
+_local = threading.local()  # stack of the stages running in each thread
+
+
+def enable(metrics_path: str = None, profile: bool = False, trace_memory: bool = False,
+           write_at_exit: bool = True):
+    """
+    turns instrumentation on, it is left as is if it is already on in this process
+    :param metrics_path: (optional) json file the metrics are written to
+    :param profile: if True every outermost stage is run under cProfile
+    :param trace_memory: if True tracemalloc records the peak python heap of each stage
+    :param write_at_exit: if True the metrics file is written when the process exits
+    :return: None
+    """
+    global _config, _pid, _started
+    if _config is not None and _pid == os.getpid():
+        return
+    _reset()
+    _config = {'metrics_path': metrics_path, 'profile': profile, 'trace_memory': trace_memory}
+    _pid = os.getpid()
+    _started = time.time()
+    if metrics_path:
+        _make_parent_dir(metrics_path)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if metrics_path and write_at_exit:
+        atexit.register(write_metrics)
+
+
+def enabled():
+    return _config is not None
+
+
+def config():
+    """
+    :return: the settings to hand to worker processes (see prepare_worker), None when off
+    """
+    return dict(_config) if _config is not None else None
+
+
+def prepare_worker(worker_config):
+    """
+    called at the start of work in a pool process so it records with the parent's settings.  A
+    forked worker starts from a fresh record rather than a copy of the parent's
+    :param worker_config: output of config() in the parent
+    :return: None
+    """
+    if worker_config is not None:
+        enable(**worker_config, write_at_exit=False)
+
+
+class _Stage:
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.profile = None
+        self.traced_start = 0
+
+    def __enter__(self):
+        stack = _stack()
+        if _config['profile'] and not any(stage.profile for stage in stack):
+            self.profile = _profiles.setdefault(self.name, cProfile.Profile())
+            try:
+                self.profile.enable()
+            except ValueError:  # another profiler is already running, e.g. in another thread
+                self.profile = None
+        if _config['trace_memory']:
+            tracemalloc.reset_peak()
+            self.traced_start = tracemalloc.get_traced_memory()[0]
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        _stack().pop()
+        if self.profile is not None:
+            self.profile.disable()
+        peak = None
+        if _config['trace_memory']:
+            peak = tracemalloc.get_traced_memory()[1] - self.traced_start
+        with _lock:
+            record = _stage_record(self.name)
+            record['calls'] += 1
+            record['seconds'] += seconds
+            record['max_seconds'] = max(record['max_seconds'], seconds)
+            if peak is not None:
+                record['peak_traced_bytes'] = max(record['peak_traced_bytes'], peak)
+
+
+class _NullStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name: str):
+    """
+    context manager timing a stage, stages can be nested
+    :param name: name the stage is recorded under
+    :return: context manager
+    """
+    if _config is None:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name: str = None):
+    """
+    decorator running every call of a function as a stage
+    :param name: (optional) stage name, defaults to the function's name
+    :return: decorator
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _config is None:
+                return func(*args, **kwargs)
+            with _Stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, amount=1):
+    """
+    increments a counter, the amount is also added to the innermost running stage
+    :param name: counter name e.g. bytes_read or tokens
+    :param amount: amount to add
+    :return: None
+    """
+    if _config is None:
+        return
+    stack = _stack()
+    with _lock:
+        _counters[name] += amount
+        if stack:
+            _stage_record(stack[-1].name)['counters'][name] += amount
+
+
+def collect():
+    """
+    hands the metrics recorded so far over (for a worker to return to the parent) and starts a
+    fresh record.  Profiles are written to their files first
+    :return: dictionary for merge(), None when off
+    """
+    if _config is None:
+        return None
+    _dump_profiles()
+    with _lock:
+        snapshot = {'stages': {name: dict(record, counters=dict(record['counters']))
+                               for name, record in _stages.items()},
+                    'counters': dict(_counters)}
+        _stages.clear()
+        _counters.clear()
+    return snapshot
+
+
+def merge(snapshot):
+    """
+    adds the metrics collected in another process
+    :param snapshot: output of collect()
+    :return: None
+    """
+    if _config is None or snapshot is None:
+        return
+    with _lock:
+        _counters.update(snapshot['counters'])
+        for name, other in snapshot['stages'].items():
+            record = _stage_record(name)
+            record['calls'] += other['calls']
+            record['seconds'] += other['seconds']
+            record['max_seconds'] = max(record['max_seconds'], other['max_seconds'])
+            record['peak_traced_bytes'] = max(record['peak_traced_bytes'],
+                                              other['peak_traced_bytes'])
+            record['counters'].update(other['counters'])
+
+
+def summary():
+    """
+    :return: dictionary of the run's metrics, None when off
+    """
+    if _config is None:
+        return None
+    with _lock:
+        stages = {}
+        for name, record in _stages.items():
+            stages[name] = {'calls': record['calls'], 'seconds': record['seconds'],
+                            'mean_seconds': record['seconds'] / record['calls'],
+                            'max_seconds': record['max_seconds'],
+                            'counters': dict(record['counters']),
+                            'per_second': {counter: amount / record['seconds']
+                                           for counter, amount in record['counters'].items()
+                                           if record['seconds'] > 0}}
+            if _config['trace_memory']:
+                stages[name]['peak_traced_mb'] = record['peak_traced_bytes'] / 2 ** 20
+        return {'command': sys.argv, 'pid': _pid, 'started': _started,
+                'wall_seconds': time.time() - _started, 'stages': stages,
+                'counters': dict(_counters)}
+
+
+def write_metrics(metrics_path: str = None):
+    """
+    writes the summary (and any profiles) of the run
+    :param metrics_path: (optional) json file, defaults to the one instrumentation was enabled with
+    :return: None
+    """
+    metrics_path = metrics_path or (_config or {}).get('metrics_path')
+    if _config is None or not metrics_path:
+        return
+    _dump_profiles()
+    _make_parent_dir(metrics_path)
+    with open(metrics_path, 'w') as fp:
+        json.dump(summary(), fp, indent=2)
+
+
+def _dump_profiles():
+    metrics_path = _config['metrics_path']
+    if not metrics_path:
+        return
+    for name, profile in _profiles.items():
+        profile.dump_stats(f'{metrics_path}.{name}.{os.getpid()}.prof')
+
+
+def _make_parent_dir(file_path):
+    directory = path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _reset():
+    _stages.clear()
+    _counters.clear()
+    _profiles.clear()
+    _local.__dict__.clear()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _stage_record(name):
+    if name not in _stages:
+        _stages[name] = {'calls': 0, 'seconds': 0., 'max_seconds': 0., 'peak_traced_bytes': 0,
+                         'counters': Counter()}
+    return _stages[name]
+
+
+if os.environ.get(_METRICS_ENV):
+    enable(os.environ[_METRICS_ENV], profile=bool(os.environ.get(_PROFILE_ENV)),
+           trace_memory=bool(os.environ.get(_TRACEMALLOC_ENV)),
+           write_at_exit=multiprocessing.parent_process() is None)
@@ -1,30 +1,71 @@
+import os
 import pickle
 import matplotlib.pyplot as plt
 import numpy as np
 from gensim import models, matutils
 from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 
-from pre_processing import load_corpus
+import instrumentation
+from gist_store import GistStore
+from pre_processing import iter_corpus, load_corpus
+from streaming_corpus import stream_vectorize
+from vocabulary import apply_dictionary, load_dictionary
 
 
-def iterate_topics(topic_range=range(10, 50, 5), number_of_records=None):
-    corpus_list, titles = load_corpus('../texts/gists/', number_of_records=number_of_records)
+def iterate_topics(topic_range=range(10, 50, 5), number_of_records=None, streaming=False,
+                   dictionary_path=None, gist_store=None, plot=True):
+    """
+    fits and saves an lda model for every number of topics in the range
+    :param topic_range: numbers of topics to try
+    :param number_of_records: hard limit on the number of gists to use
+    :param streaming: if True the gists are vectorized out of core (see streaming_corpus) so the
+                      corpus does not have to fit in memory
+    :param gist_store: (optional) GistStore directory to train from instead of the gist text files,
+                       no tokenizing is needed (number_of_records does not apply)
+    :param dictionary_path: (optional) pruned vocabulary saved by vocabulary.py, the corpus is
+                            restricted to its words before training
+    :param plot: if True the topic difference heatmaps are made after training (see
+                 topic_comparison), each model with itself and the first with the last
+    :return: list of the fit models
+    """
+    if gist_store:
+        with instrumentation.stage('load_gist_store'):
+            corpus, id2word, titles = GistStore(gist_store).to_corpus()
+    elif streaming:
+        gists = iter_corpus('../texts/gists/', number_of_records=number_of_records)
+        with instrumentation.stage('stream_vectorize'):
+            corpus = stream_vectorize(gists, '../outputs/streamed_corpus')
+        titles, id2word = corpus.titles(), corpus.id2word()
+    else:
+        with instrumentation.stage('load_corpus'):
+            corpus_list, titles = load_corpus('../texts/gists/',
+                                              number_of_records=number_of_records)
+        count_vect = fit_vectorizer(corpus_list)
+        corpus, id2word = convert_corpus(corpus_list, count_vect)
+    instrumentation.count('documents', len(titles))
+    if dictionary_path:
+        with instrumentation.stage('apply_dictionary'):
+            corpus, id2word = apply_dictionary(corpus, id2word, load_dictionary(dictionary_path),
+                                               '../outputs/pruned_corpus')
     with open('../outputs/iter_titles.pkl', 'wb') as fp:
         pickle.dump(titles, fp)
     models = []
-    count_vect =  fit_vectorizer(corpus_list)
-    corpus, id2word = convert_corpus(corpus_list, count_vect)
     with open('../outputs/iter_corpus.pkl', 'wb') as fp:
         pickle.dump(corpus, fp)
     for num_tops in topic_range:
         lda_loop = fit_lda(num_tops, corpus, id2word, 100, multicore=2, save=True)
-        plot_distances(lda_loop, title=f'Differences {num_tops} Topics')
         models.append(lda_loop)
-    plot_distances(models[0], title=f'Comparing {topic_range[0]} to {topic_range[-1]} Topics',
-                   other_model=models[-1])
+    if plot:
+        from topic_comparison import compare_models  # topic_comparison imports this module
+
+        model_paths = [os.path.join('../outputs/', f'lda_{num_tops}_topics.mdl')
+                       for num_tops in topic_range]
+        pairs = [(model_path, model_path) for model_path in model_paths]
+        compare_models(model_paths, pairs=pairs + [(model_paths[0], model_paths[-1])])
     return models
 
 
+@instrumentation.timed()
 def fit_vectorizer(corpus_list, vec_type='Count', **kwargs):
     """
     Creates a fit vectorizer object from the corpus
@@ -37,6 +78,7 @@ def fit_vectorizer(corpus_list, vec_type='Count', **kwargs):
     return vectorizer
 
 
+@instrumentation.timed()
 def convert_corpus(corpus_list: list, count_vec: CountVectorizer):
     doc_term_mat = count_vec.transform(corpus_list).transpose()
     corpus = matutils.Sparse2Corpus(doc_term_mat)
@@ -44,7 +86,8 @@ def convert_corpus(corpus_list: list, count_vec: CountVectorizer):
     return corpus, id2word
 
 
-def fit_lda(num_topics, corpus, id2word, passes, multicore=0, save=True):
+@instrumentation.timed()
+def fit_lda(num_topics, corpus, id2word, passes, multicore=0, save=True, save_dir='../outputs/'):
     """
     Fits a gensim lda model on the corpus,  Allows for easy switching between single and multicore
     implementations
@@ -53,6 +96,7 @@ def fit_lda(num_topics, corpus, id2word, passes, multicore=0, save=True):
     :param id2word:
     :param passes:
     :param multicore:
+    :param save_dir: directory the model is saved to
     :return:
     """
     if multicore:
@@ -63,10 +107,11 @@ def fit_lda(num_topics, corpus, id2word, passes, multicore=0, save=True):
                                   passes=passes)
 
     if save:
-        lda_fit.save(f'../outputs/lda_{num_topics}_topics.mdl')
+        lda_fit.save(os.path.join(save_dir, f'lda_{num_topics}_topics.mdl'))
     return lda_fit
 
 
+@instrumentation.timed()
 def plot_distances(lda: models.LdaModel, distance='jaccard', num_words=50, title=None, other_model=None):
     comparison = True
     if not other_model:
@@ -76,7 +121,8 @@ def plot_distances(lda: models.LdaModel, distance='jaccard', num_words=50, title
     topic_difference_heatmap(mdiff=mdiff, title=title, diff_models=comparison)
 
 
-def topic_difference_heatmap(mdiff, title=None, diff_models=False, dir='../outputs/'):
+def topic_difference_heatmap(mdiff, title=None, diff_models=False, dir='../outputs/',
+                             file_name=None):
     """
     Plots the output of gensim's LDA.diff() method.
     It filters out th upper half of the symmetric matrix
@@ -88,12 +134,14 @@ def topic_difference_heatmap(mdiff, title=None, diff_models=False, dir='../outpu
                         models. If the value is False then the top half of the mdiff array is masked
                         away because if the models are the same the maxtrix is symmetric about above
                         and below the identity matrix
+    :param dir: directory to save the plot to
+    :param file_name: (optional) name of the .png without the extension, defaults to the title
     :return:
     """
     if not title:
         title = 'Topic Differences'
     if not diff_models:
-        mask = np.zeros_like(mdiff, dtype=np.bool)
+        mask = np.zeros_like(mdiff, dtype=bool)
         mask[np.triu_indices_from(mask)] = True
         masked = np.ma.masked_array(mdiff, mask=mask)
     else:
@@ -105,7 +153,8 @@ def topic_difference_heatmap(mdiff, title=None, diff_models=False, dir='../outpu
     plt.colorbar(data)
     ax.invert_yaxis()
 
-    plt.savefig(f'../outputs/{title}.png', dpi=300)
+    plt.savefig(os.path.join(dir, f'{file_name or title}.png'), dpi=300)
+    plt.close(fig)
 
 
 if __name__ == '__main__':
@@ -113,8 +162,10 @@ if __name__ == '__main__':
     # count_vect = fit_vectorizer(corp_list)
     # corpus, id2word = convert_corpus(corp_list, count_vect)
     # lda = fit_lda(num_topics=10, corpus=corpus, id2word=id2word, passes=100)
-    for topics in range(10, 40, 5):
-        lda = models.LdaModel.load(f'../outputs/small_dataset_models/lda_{topics}_topics.mdl')
-        plot_distances(lda, 'jaccard', 30, f'LDA: Distances Between {topics} Topics')
+    from topic_comparison import compare_models
+
+    small_models = [f'../outputs/small_dataset_models/lda_{topics}_topics.mdl'
+                    for topics in range(10, 40, 5)]
+    compare_models(small_models, num_words=30, pairs=[(model, model) for model in small_models])
     # lda.print_topics()
     # iterate_topics(number_of_records=1500)
\ No newline at end of file
@@ -0,0 +1,152 @@
+"""
+Local SQLite index of gutenberg book metadata
+
+The gutenberg python library needs Berkeley DB and is far too slow to call once per recommended
+book, so this module extracts id -> (title, author, language, subjects) once into a small SQLite
+file and answers batched lookups from it.
+
+Building from the project gutenberg RDF catalog (no Berkeley DB needed):
+    $ wget http://www.gutenberg.org/cache/epub/feeds/rdf-files.tar.bz2
+    $ python metadata_index.py rdf-files.tar.bz2 ../outputs/metadata.sqlite
+"""
+
+
+import logging
+import os
+import sqlite3
+import tarfile
+import threading
+from sys import argv
+from typing import Iterable, List
+from xml.etree import ElementTree
+
+_NAMESPACES = {'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+               'dcterms': 'http://purl.org/dc/terms/',
+               'pgterms': 'http://www.gutenberg.org/2009/pgterms/'}
+_SUBJECT_SEPARATOR = '; '
+_BATCH_SIZE = 900  # stays under sqlite's default limit on query parameters
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS books (
+                 id INTEGER PRIMARY KEY,
+                 title TEXT,
+                 author TEXT,
+                 language TEXT,
+                 subjects TEXT)'''
+
+
+def build_metadata_index(records: Iterable[tuple], db_path: str, batch_size: int = 10000):
+    """
+    writes metadata records into the index, existing ids are replaced
+    :param records: iterable of (id, title, author, language, subjects) tuples, subjects is a
+                    list of strings
+    :param db_path: location of the sqlite file
+    :param batch_size: number of records to insert per transaction
+    :return: number of records written
+    """
+    count = 0
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute(_SCHEMA)
+        batch = []
+        for book_id, title, author, language, subjects in records:
+            batch.append((int(book_id), title, author, language, _SUBJECT_SEPARATOR.join(subjects)))
+            if len(batch) >= batch_size:
+                count += _insert(conn, batch)
+                batch = []
+        count += _insert(conn, batch)
+    conn.close()
+    logging.info(f'{count} metadata records written to {db_path}')
+    return count
+
+
+def extract_rdf_metadata(rdf_archive: str):
+    """
+    streams the metadata out of the project gutenberg RDF catalog archive one book at a time
+    :param rdf_archive: location of rdf-files.tar.bz2 (or any tar of pg<id>.rdf files)
+    :return: generator of (id, title, author, language, subjects) tuples
+    """
+    with tarfile.open(rdf_archive, 'r|*') as archive:
+        for member in archive:
+            name = os.path.basename(member.name)
+            if not (member.isfile() and name.startswith('pg') and name.endswith('.rdf')):
+                continue
+            try:
+                book_id = int(name[2:-4])
+                root = ElementTree.parse(archive.extractfile(member)).getroot()
+            except (ValueError, ElementTree.ParseError):
+                logging.debug(f'could not parse {member.name}')
+                continue
+            yield (book_id, *_parse_rdf(root))
+
+
+def extract_library_metadata(ids: Iterable[int]):
+    """
+    pulls the metadata for the given ids through the gutenberg python library.  This is slow and
+    needs Berkeley DB but only has to run once per catalogue
+    :param ids: gutenberg ids
+    :return: generator of (id, title, author, language, subjects) tuples
+    """
+    from gutenberg.query.api import get_metadata
+
+    for book_id in ids:
+        title, author, language = (_first(get_metadata(attr, book_id))
+                                   for attr in ('title', 'author', 'language'))
+        subjects = sorted(get_metadata('subject', book_id))
+        yield book_id, title, author, language, subjects
+
+
+class MetadataIndex:
+    """
+    Read only, batched access to the metadata index.  The connection is opened once and can be
+    shared between threads, queries on it are serialized with a lock.
+    """
+
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def lookup(self, ids: List[int]):
+        """
+        fetches the metadata of many books with as few queries as possible
+        :param ids: gutenberg ids, numpy integers are fine
+        :return: dictionary of id to (title, author, language, subjects), unknown ids are missing
+        """
+        found = {}
+        ids = [int(book_id) for book_id in ids]  # sqlite3 binds numpy integers as blobs
+        for start in range(0, len(ids), _BATCH_SIZE):
+            batch = ids[start:start + _BATCH_SIZE]
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT id, title, author, language, subjects FROM books '
+                    f'WHERE id IN ({",".join("?" * len(batch))})', batch).fetchall()
+            for book_id, title, author, language, subjects in rows:
+                found[book_id] = (title, author, language,
+                                  subjects.split(_SUBJECT_SEPARATOR) if subjects else [])
+        return found
+
+    def close(self):
+        self.conn.close()
+
+
+def _parse_rdf(root):
+    ebook = root.find('pgterms:ebook', _NAMESPACES)
+    if ebook is None:
+        return '', '', '', []
+    title = ebook.findtext('dcterms:title', '', _NAMESPACES)
+    author = ebook.findtext('dcterms:creator/pgterms:agent/pgterms:name', '', _NAMESPACES)
+    language = ebook.findtext('dcterms:language/rdf:Description/rdf:value', '', _NAMESPACES)
+    subjects = [subject.text for subject in
+                ebook.findall('dcterms:subject/rdf:Description/rdf:value', _NAMESPACES)]
+    return title, author, language, subjects
+
+
+def _first(values):
+    return sorted(values)[0] if values else ''
+
+
+def _insert(conn, batch):
+    conn.executemany('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?)', batch)
+    return len(batch)
+
+
+if __name__ == '__main__':
+    build_metadata_index(extract_rdf_metadata(argv[1]), *argv[2:])
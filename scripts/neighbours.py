@@ -0,0 +1,362 @@
+"""
+Nearest neighbour search over the document to topic matrix
+
+Exact search scores every book with one matrix-vector product.  The approximate search uses a
+forest of random projection trees (similar in spirit to Annoy) so only the books sharing leaves
+with the query are scored.  Either can produce a shortlist that TfidfReranker reorders by a blend
+of topic and tf-idf similarity.
+"""
+
+
+import heapq
+import time
+from sys import argv
+
+import numpy as np
+from scipy import sparse
+
+
+def normalize_rows(doc_topics):
+    """
+    scales every row of the document to topic matrix to unit length so that the dot product of two
+    rows is their cosine similarity.  All zero rows are left as zeros
+    :param doc_topics: document topics matrix
+    :return: float32 numpy array of the same shape
+    """
+    norms = np.linalg.norm(doc_topics, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return (doc_topics / norms).astype(np.float32)
+
+
+def profile_vector(doc_topics, indices, weights=None):
+    """
+    combines several rows into one unit length query vector
+    :param doc_topics: row normalized document topics matrix
+    :param indices: rows to combine
+    :param weights: (optional) weight of each row, defaults to equal weights.  All zero weights
+                    (e.g. all zero ratings) also give equal weights
+    :return: unit length topic vector
+    """
+    weights = check_weights(indices, weights)
+    profile = np.average(doc_topics[list(indices)], axis=0, weights=weights)
+    return normalize_rows(profile[None, :])[0]
+
+
+def check_weights(indices, weights):
+    """
+    validates the weights of a profile
+    :param indices: rows to combine
+    :param weights: weight of each row or None
+    :return: the weights as a float array, None for equal weights
+    """
+    if weights is None:
+        return None
+    weights = np.asarray(weights, dtype=float)
+    if weights.shape != (len(indices),):
+        raise ValueError(f'expected one weight per row ({len(indices)}), got {weights.shape}')
+    if not weights.any():
+        return None
+    if weights.sum() == 0:
+        raise ValueError('the weights of a profile must not sum to zero')
+    return weights
+
+
+def top_k(scores, k, exclude=()):
+    """
+    returns the indices of the k highest scores in descending order using a partial sort
+    :param scores: 1d array of similarity scores, it is modified in place
+    :param k: number of indices to return
+    :param exclude: indices that should never be returned e.g. the query book itself
+    :return: numpy array of at most k indices
+    """
+    scores[list(exclude)] = -np.inf
+    k = min(k, len(scores) - len(set(exclude)))
+    if k <= 0:
+        return np.array([], dtype=int)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def top_k_rows(scores, k, exclude=None):
+    """
+    row wise version of top_k for a block of queries
+    :param scores: 2d array (queries, documents) of similarity scores, it is modified in place
+    :param k: number of indices to return per row
+    :param exclude: (optional) one document index per row that should never be returned
+    :return: numpy arrays (queries, k) of indices and of their scores, in descending order
+    """
+    rows = np.arange(len(scores))
+    if exclude is not None:
+        scores[rows, exclude] = -np.inf
+    num_cols = scores.shape[1]
+    k = min(k, num_cols - (exclude is not None))
+    if k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64), np.empty((len(scores), 0), scores.dtype)
+    # the highest k end up last, partitioning scores itself (not a negated copy) leaves
+    # argpartition's index array as the only temporary as large as scores
+    candidates = np.argpartition(scores, num_cols - k, axis=1)[:, num_cols - k:]
+    candidate_scores = scores[rows[:, None], candidates]
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    return (np.take_along_axis(candidates, order, axis=1),
+            np.take_along_axis(candidate_scores, order, axis=1))
+
+
+def exact_neighbours(query, doc_topics, k, exclude=()):
+    """
+    brute force cosine search
+    :param query: unit length topic vector
+    :param doc_topics: row normalized document topics matrix
+    :param k: number of neighbours
+    :param exclude: indices to leave out of the results
+    :return: indices of the k most similar rows
+    """
+    return top_k(doc_topics @ query, k, exclude)
+
+
+def tfidf_matrix(doc_term):
+    """
+    tf-idf weights of a count corpus with every row scaled to unit length, the weighting of
+    sklearn's TfidfVectorizer defaults (raw counts times the smoothed idf)
+    :param doc_term: scipy sparse (documents, terms) count matrix
+    :return: float32 scipy sparse csr matrix of the same shape
+    """
+    tfidf = sparse.csr_matrix(doc_term, dtype=np.float32, copy=True)
+    doc_freq = np.bincount(tfidf.indices, minlength=tfidf.shape[1])
+    idf = np.log((1 + tfidf.shape[0]) / (1 + doc_freq)) + 1
+    tfidf.data *= idf[tfidf.indices].astype(np.float32)
+    norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    tfidf.data /= np.repeat(norms, np.diff(tfidf.indptr)).astype(np.float32)
+    return tfidf
+
+
+class TfidfReranker:
+    """
+    Reorders a shortlist of topic neighbours by a blend of their topic and tf-idf cosine
+    similarities to the query.  Only the shortlisted rows of the tf-idf matrix are read, so a query
+    costs the same however large the corpus is.  Shared vocabulary separates books that lda only
+    places in the same broad topics, which matters most for books with few close neighbours.
+    """
+
+    def __init__(self, tfidf, blend: float = .3, shortlist: int = 200):
+        """
+        :param tfidf: scipy sparse csr (documents, terms) matrix with unit length rows, see
+                      tfidf_matrix
+        :param blend: weight of the tf-idf similarity, 0 keeps the topic order and 1 ranks the
+                      shortlist by tf-idf alone
+        :param shortlist: number of topic neighbours that are reranked
+        """
+        self.tfidf = tfidf
+        self.blend = blend
+        self.shortlist = shortlist
+
+    def query_vector(self, indices, weights=None):
+        """
+        the tf-idf version of profile_vector
+        :param indices: rows to combine
+        :param weights: (optional) weight of each row, defaults to equal weights
+        :return: unit length scipy sparse (1, terms) vector
+        """
+        weights = check_weights(indices, weights)
+        weights = np.ones(len(indices)) if weights is None else weights
+        query = sparse.csr_matrix(weights[None, :]) @ self.tfidf[list(indices)]
+        norm = np.sqrt(query.multiply(query).sum())
+        return query / norm if norm else query
+
+    def rerank(self, candidates, topic_query, doc_topics, tfidf_query, k):
+        """
+        scores the candidates by both similarities and keeps the best k
+        :param candidates: shortlisted row indices
+        :param topic_query: unit length topic vector
+        :param doc_topics: row normalized document topics matrix
+        :param tfidf_query: output of query_vector
+        :param k: number of indices to return
+        :return: numpy arrays of at most k indices and of their blended scores, in descending order
+        """
+        candidates = np.asarray(candidates, dtype=np.int64)
+        topic_scores = doc_topics[candidates] @ topic_query
+        text_scores = np.asarray((self.tfidf[candidates] @ tfidf_query.T).todense()).ravel()
+        scores = (1 - self.blend) * topic_scores + self.blend * text_scores
+        best = top_k(scores.copy(), k)
+        return candidates[best], scores[best]
+
+
+class RandomProjectionForest:
+    """
+    Approximate cosine nearest neighbour index.  Each tree recursively splits the books by the
+    hyperplane halfway between two randomly chosen books until a leaf holds at most leaf_size
+    books.  All trees are stored flat in numpy arrays so the index can be saved with np.savez.
+    """
+
+    def __init__(self, num_trees: int = 10, leaf_size: int = 32, seed: int = 0):
+        self.num_trees = num_trees
+        self.leaf_size = leaf_size
+        self.seed = seed
+        self.vectors = None
+        self.normals = None
+        self.offsets = None
+        self.children = None
+        self.leaf_bounds = None
+        self.leaf_items = None
+        self.roots = None
+
+    def build(self, vectors):
+        """
+        builds the forest
+        :param vectors: row normalized document topics matrix
+        :return: self
+        """
+        rng = np.random.default_rng(self.seed)
+        self.vectors = vectors
+        normals, offsets, children, leaf_bounds, leaf_items, roots = [], [], [], [], [], []
+
+        def new_node():
+            normals.append(np.zeros(vectors.shape[1], dtype=np.float32))
+            offsets.append(0.)
+            children.append([-1, -1])
+            leaf_bounds.append([0, 0])
+            return len(offsets) - 1
+
+        for _ in range(self.num_trees):
+            roots.append(new_node())
+            stack = [(roots[-1], np.arange(len(vectors)))]
+            while stack:
+                node, items = stack.pop()
+                if len(items) <= self.leaf_size:
+                    leaf_bounds[node] = [len(leaf_items), len(leaf_items) + len(items)]
+                    leaf_items.extend(items)
+                    continue
+                first, second = vectors[rng.choice(items, 2, replace=False)]
+                normal = first - second
+                offset = normal @ (first + second) / 2
+                side = vectors[items] @ normal > offset
+                if side.all() or not side.any():
+                    # identical points, fall back to a random split
+                    side = rng.random(len(items)) < .5
+                normals[node] = normal
+                offsets[node] = offset
+                children[node] = [new_node(), new_node()]
+                stack.append((children[node][0], items[~side]))
+                stack.append((children[node][1], items[side]))
+
+        self.normals = np.array(normals, dtype=np.float32)
+        self.offsets = np.array(offsets, dtype=np.float32)
+        self.children = np.array(children, dtype=np.int32)
+        self.leaf_bounds = np.array(leaf_bounds, dtype=np.int64)
+        self.leaf_items = np.array(leaf_items, dtype=np.int32)
+        self.roots = np.array(roots, dtype=np.int32)
+        return self
+
+    def query(self, query, k, exclude=(), search_k=None):
+        """
+        finds approximate nearest neighbours.  Nodes of all trees are visited best first by their
+        margin to the splitting hyperplane until search_k candidates are found, the candidates are
+        then ranked exactly
+        :param query: unit length topic vector
+        :param k: number of neighbours
+        :param exclude: indices to leave out of the results
+        :param search_k: number of candidates to score, defaults to num_trees * k * 2
+        :return: indices of the k most similar rows found
+        """
+        if search_k is None:
+            search_k = self.num_trees * k * 2
+        heap = [(-np.inf, int(root)) for root in self.roots]
+        candidates = set()
+        while heap and len(candidates) < search_k:
+            priority, node = heapq.heappop(heap)
+            left, right = self.children[node]
+            if left < 0:
+                start, end = self.leaf_bounds[node]
+                candidates.update(self.leaf_items[start:end].tolist())
+                continue
+            margin = float(query @ self.normals[node] - self.offsets[node])
+            heapq.heappush(heap, (max(priority, margin), int(left)))
+            heapq.heappush(heap, (max(priority, -margin), int(right)))
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        keep = np.isin(candidates, list(exclude), invert=True)
+        candidates = candidates[keep]
+        ranked = top_k(self.vectors[candidates] @ query, k)
+        return candidates[ranked]
+
+    def save(self, file_path):
+        """
+        saves the forest, the vectors are not saved and must be supplied again on load
+        :param file_path: location of the .npz file
+        :return: None
+        """
+        with open(file_path, 'wb') as fp:
+            np.savez(fp, normals=self.normals, offsets=self.offsets, children=self.children,
+                     leaf_bounds=self.leaf_bounds, leaf_items=self.leaf_items, roots=self.roots,
+                     params=np.array([self.num_trees, self.leaf_size, self.seed]))
+
+    @classmethod
+    def load(cls, file_path, vectors):
+        """
+        loads a saved forest
+        :param file_path: location of the .npz file
+        :param vectors: the row normalized document topics matrix the forest was built on
+        :return: RandomProjectionForest
+        """
+        with np.load(file_path) as arrays:
+            num_trees, leaf_size, seed = arrays['params'].tolist()
+            forest = cls(num_trees, leaf_size, seed)
+            forest.normals = arrays['normals']
+            forest.offsets = arrays['offsets']
+            forest.children = arrays['children']
+            forest.leaf_bounds = arrays['leaf_bounds']
+            forest.leaf_items = arrays['leaf_items']
+            forest.roots = arrays['roots']
+        forest.vectors = vectors
+        return forest
+
+
+def recall_at_k(index, doc_topics, k=10, search_k=None, sample_size=500, seed=0):
+    """
+    measures how many of the exact top k neighbours the approximate index finds
+    :param index: a built RandomProjectionForest
+    :param doc_topics: row normalized document topics matrix
+    :param k: number of neighbours
+    :param search_k: passed through to index.query
+    :param sample_size: number of books to query
+    :param seed: seed for choosing the sampled books
+    :return: mean recall, mean exact query seconds, mean approximate query seconds
+    """
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(doc_topics), min(sample_size, len(doc_topics)), replace=False)
+    hits = 0
+    exact_time = approx_time = 0.
+    for ind in sample:
+        start = time.perf_counter()
+        exact = exact_neighbours(doc_topics[ind], doc_topics, k, exclude=[ind])
+        exact_time += time.perf_counter() - start
+        start = time.perf_counter()
+        approx = index.query(doc_topics[ind], k, exclude=[ind], search_k=search_k)
+        approx_time += time.perf_counter() - start
+        hits += len(np.intersect1d(exact, approx))
+    return hits / (len(sample) * k), exact_time / len(sample), approx_time / len(sample)
+
+
+def print_recall_report(index, doc_topics, k=10, search_ks=(None, 100, 200, 500, 1000, 2000)):
+    """
+    prints recall@k and query times for a range of search_k values so the speed/quality trade off
+    can be chosen
+    :param index: a built RandomProjectionForest
+    :param doc_topics: row normalized document topics matrix
+    :param k: number of neighbours
+    :param search_ks: search_k values to try
+    :return: None
+    """
+    format_str = '{:>10} | {:>10} | {:>12} | {:>12}'
+    print(format_str.format('search_k', f'recall@{k}', 'exact ms', 'approx ms'))
+    print('—' * 53)
+    for search_k in search_ks:
+        recall, exact_time, approx_time = recall_at_k(index, doc_topics, k, search_k)
+        print(format_str.format(str(search_k), f'{recall:.3f}', f'{exact_time * 1000:.3f}',
+                                f'{approx_time * 1000:.3f}'))
+
+
+if __name__ == '__main__':
+    # python neighbours.py <path to .doc_topics.npy> [num trees] [leaf size]
+    topics = normalize_rows(np.load(argv[1]))
+    forest = RandomProjectionForest(*[int(arg) for arg in argv[2:]]).build(topics)
+    print_recall_report(forest, topics)
@@ -1,15 +1,32 @@
 import os
 import sys
 import re
+import zlib
 import logging
 from collections import Counter
+from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from typing import List
 from string import punctuation
 
-from nltk.tokenize import word_tokenize
+from nltk.tokenize import NLTKWordTokenizer, word_tokenize
+
+import instrumentation
+from gist_store import GistStore
 
 Corpus = List[str]
 
+_PUNCT = "".join(punctuation.split("'"))  # leave apostrophes
+# punctuation (except ') or a run of word characters containing a digit, in one pass.  _ is left out
+# of the word characters because it is punctuation and gets blanked on its own.  The lookbehinds
+# only let a match start at the beginning of a word/chunk which avoids quadratic backtracking
+_CLEAN_PATTERN = re.compile(rf'[{re.escape(_PUNCT)}]|(?<![^\W_])[^\W_]*\d[^\W_]*')
+# whitespace separated chunks the nltk tokenizer would change: apostrophes, quotes, dashes and the
+# contractions it splits.  Everything else is already a token once the text is cleaned
+_SPLIT_PATTERN = re.compile(r"(?<!\S)\S*?(?:['«»“”‘’„\u2012-\u2015]|"
+                            r"\b(?:cannot|gimme|gonna|gotta|lemme|wanna)\b)\S*")
+_word_tokenizer = NLTKWordTokenizer()
+
 logFormatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
 rootLogger = logging.getLogger()
 consoleHandler = logging.StreamHandler(sys.stdout)
@@ -18,7 +35,8 @@ rootLogger.addHandler(consoleHandler)
 rootLogger.setLevel(logging.DEBUG)
 
 
-def load_corpus(directory: str = './', skip_dir: str = '', number_of_records: int = None):
+def load_corpus(directory: str = './', skip_dir: str = '', number_of_records: int = None,
+                **kwargs):
     """
     this is a workhorse of a function.  It loads the data from the specified directory and has ways
     to limit what gets loaded so that the whole corpus doesn't get loaded every time for every thing
@@ -27,65 +45,201 @@ def load_corpus(directory: str = './', skip_dir: str = '', number_of_records: in
     :param directory: directory to load all .txt files from
     :param skip_dir: if a file of the same name appears in this directory then it will not be loaded
     :param number_of_records: hard limit on the number of documents to load
+    :param kwargs: shard, num_shards, sample, ids and seed filters, see iter_corpus_files
     :return:
     """
     corpus = []
     indexing = []
-    try:
-        skip_list = os.listdir(skip_dir)
-    except FileNotFoundError:
-        skip_list = []
-    skip_list.extend(['.DS_Store'])
-    dir_contents = os.listdir(directory)
-    if not number_of_records:
-        number_of_records = len(dir_contents)
-    for file in dir_contents:
-        if file in skip_list:
-            continue
-        file_path = os.path.join(directory, file)
-        logging.debug(f'Attempting to open {file_path}')
-        try:
-            with open(file_path, 'r') as file_stream:
-                corpus.append(file_stream.read())
-        except IsADirectoryError:
-            logging.debug(f'{file_path} is a directory')
-        else:
-            indexing.append(file[:-4])
-            if len(indexing) >=  number_of_records:
-                break
+    for title, text in iter_corpus(directory, skip_dir, number_of_records, **kwargs):
+        corpus.append(text)
+        indexing.append(title)
 
     return corpus, indexing
 
 
+def iter_corpus(directory: str = './', skip_dir: str = '', number_of_records: int = None,
+                **kwargs):
+    """
+    lazy version of load_corpus, only one document is held in memory at a time
+    :param directory: directory to load all .txt files from
+    :param skip_dir: if a file of the same name appears in this directory then it will not be loaded
+    :param number_of_records: hard limit on the number of documents to load
+    :param kwargs: shard, num_shards, sample, ids and seed filters, see iter_corpus_files
+    :return: generator of (title, text) tuples
+    """
+    for title, file_path in iter_corpus_files(directory, skip_dir, number_of_records, **kwargs):
+        with open(file_path, 'r') as file_stream:
+            text = file_stream.read()
+        instrumentation.count('characters_read', len(text))
+        yield title, text
+
+
+def iter_corpus_files(directory: str = './', skip_dir: str = '', number_of_records: int = None,
+                      shard: int = 0, num_shards: int = 1, sample: float = None, ids=None,
+                      seed: int = 0):
+    """
+    finds the .txt files of the corpus without opening them, hidden files are ignored.  Sharding
+    and sampling are decided by a hash of the file's title so they are deterministic, independent
+    of the order the directory is listed in, and the shards of a corpus never overlap
+    :param directory: directory to find all .txt files in
+    :param skip_dir: if a file of the same name appears in this directory then it will be skipped
+    :param number_of_records: hard limit on the number of documents to find
+    :param shard: which shard to return, 0 <= shard < num_shards
+    :param num_shards: number of shards to split the corpus into
+    :param sample: (optional) fraction of the corpus to keep, between 0 and 1
+    :param ids: (optional) collection of titles/gutenberg ids, only these are returned
+    :param seed: changes which documents end up in the sample
+    :return: generator of (title, file path) tuples
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError(f'shard must be between 0 and {num_shards - 1}, got {shard}')
+    try:
+        skip_list = set(os.listdir(skip_dir))
+    except FileNotFoundError:
+        skip_list = set()
+    skip_list.add('.DS_Store')
+    if ids is not None:
+        ids = {str(id_loop) for id_loop in ids}
+    count = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name in skip_list:
+                continue
+            if not entry.is_file():
+                logging.debug(f'{entry.path} is a directory')
+                continue
+            if entry.name.startswith('.') or not entry.name.endswith('.txt'):
+                continue  # hidden files and the temp files of interrupted writes
+            title = entry.name[:-4]
+            if ids is not None and title not in ids:
+                continue
+            if num_shards > 1 and zlib.crc32(title.encode()) % num_shards != shard:
+                continue
+            if sample is not None and zlib.crc32(f'{seed}:{title}'.encode()) >= sample * 2 ** 32:
+                continue
+            logging.debug(f'Found {entry.path}')
+            yield title, entry.path
+            count += 1
+            if number_of_records and count >= number_of_records:
+                break
+
 
-def gistify(input_dir: str, output_dir: str):
+def gistify(input_dir: str, output_dir: str, workers: int = None, max_in_flight: int = None,
+            store: bool = False, **kwargs):
     """
     main function that oversees creating gists of the corpus.  The function skips any files that
-    already appear in the output directory.
+    already appear in the output directory.  Files are found lazily and handed to a pool of worker
+    processes which read, gist and save one book each, so at most max_in_flight books are in memory
+    at once no matter how large the corpus is.
     :param input_dir: directory containing the raw text files
-    :param output_dir: directory to save the gist text files
+    :param output_dir: directory to save the gist text files, or the GistStore directory
+    :param workers: number of worker processes, defaults to the number of cpus
+    :param max_in_flight: number of books submitted but not yet finished, defaults to 2 * workers
+    :param store: if True the gists are added to a GistStore (see gist_store.py) in output_dir
+                  instead of being saved as one text file each, books already in it are skipped
+    :param kwargs: shard, num_shards, sample, ids and seed filters, see iter_corpus_files
     :return: None
     """
-    corpus, titles = load_corpus(input_dir, output_dir)
-    print('\n\t\t', len(corpus))
-    for ind, book in enumerate(corpus):
-        logging.debug(f'Attempting to Gistify: {titles[ind]}')
-        gist, gist_token = create_gist(book)
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
+    finished = 0
+    pending = set()
+    worker_config = instrumentation.config()
+    gist_store = GistStore(output_dir) if store else None
+    books = iter_corpus_files(input_dir, '' if store else output_dir, **kwargs)
+    failures = []
+    try:
+        with instrumentation.stage('gistify'), ProcessPoolExecutor(workers) as pool:
+            for title, file_path in books:
+                if failures:
+                    break  # nothing new is submitted, the books in flight are still collected
+                if store and title in gist_store:
+                    continue
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    finished += _check_finished(done, failures, gist_store)
+                pending.add(pool.submit(_gistify_worker, file_path, None if store else output_dir,
+                                        title, worker_config))
+            finished += _check_finished(wait(pending).done, failures, gist_store)
+    finally:
+        if store:
+            gist_store.flush()  # the gists that did finish are kept even if a worker failed
+    logging.info(f'{finished} gists created in {output_dir}')
+    if failures:
+        raise failures[0]
+
+
+def gistify_file(file_path: str, output_dir: str, title: str):
+    """
+    reads, gists and saves a single book, this is what the gistify workers run
+    :param file_path: location of the raw text file
+    :param output_dir: directory to save the gist to
+    :param title: title to give to the gist file
+    :return: the title
+    """
+    logging.debug(f'Attempting to Gistify: {title}')
+    with instrumentation.stage('gistify_file'):
+        gist, gist_token = _read_and_gist(file_path)
         logging.debug('\tSaving gist')
-        save_gist(output_dir, titles[ind], gist)
+        save_gist(output_dir, title, gist)
+    return title
+
+
+def _read_and_gist(file_path):
+    with open(file_path, 'r') as file_stream:
+        book = file_stream.read()
+        instrumentation.count('bytes_read', os.fstat(file_stream.fileno()).st_size)
+    instrumentation.count('books')
+    return create_gist(book)
+
+
+def _gistify_worker(file_path, output_dir, title, worker_config):
+    # runs in the pool, the worker's metrics are sent back to be merged into the parent's.  Without
+    # an output_dir the gist's word counts are sent back for the parent to add to its GistStore
+    instrumentation.prepare_worker(worker_config)
+    counts = None
+    if output_dir is None:
+        with instrumentation.stage('gistify_file'):
+            gist, gist_tokens = _read_and_gist(file_path)
+            counts = Counter(gist_tokens)
+    else:
+        gistify_file(file_path, output_dir, title)
+    return title, counts, instrumentation.collect()
+
+
+def _check_finished(futures, failures, gist_store=None):
+    # the exception of a failed worker is appended to failures, the other books are still counted
+    finished = 0
+    for future in futures:
+        try:
+            title, counts, metrics = future.result()
+        except Exception as error:
+            failures.append(error)
+            continue
+        instrumentation.merge(metrics)
+        if gist_store is not None:
+            gist_store.add(title, counts)
+        finished += 1
+    return finished
 
 
-def create_gist(document: str, gist_depth: int = 1000):
+def create_gist(document: str, gist_depth: int = 1000, tokenizer: str = 'fast'):
     """
 
     :param document:
     :param gist_depth:
+    :param tokenizer: 'fast' (see fast_pre_processing) or 'nltk' (see gist_pre_processing), both
+                      produce the same tokens
     :return: gist and tokenized gist
     """
-    clean_tokens = gist_pre_processing(document)
-    top_words = get_top_words(clean_tokens, gist_depth)
-
-    gist, gist_tokens = filter_to_gist(clean_tokens, top_words)
+    tokenizer_dict = {'fast': fast_pre_processing, 'nltk': gist_pre_processing}
+    with instrumentation.stage('tokenize'):
+        clean_tokens = tokenizer_dict[tokenizer.lower()](document)
+        instrumentation.count('tokens', len(clean_tokens))
+    with instrumentation.stage('filter_to_gist'):
+        top_words = get_top_words(clean_tokens, gist_depth)
+        gist, gist_tokens = filter_to_gist(clean_tokens, top_words)
+        instrumentation.count('gist_tokens', len(gist_tokens))
 
     return gist, gist_tokens
 
@@ -97,14 +251,38 @@ def gist_pre_processing(document: str):
     :param document: string
     :return: cleaned tokens of the document
     """
-    punct = "".join(punctuation.split("'"))  # leave apostrophes
-    no_punctuation = re.sub(f'[{re.escape(punct)}]', ' ', document)
+    no_punctuation = re.sub(f'[{re.escape(_PUNCT)}]', ' ', document)
     no_nums_no_punc = re.sub('\w*\d\w*', ' ', no_punctuation)
     clean_tokens = word_tokenize(no_nums_no_punc.lower())
 
     return clean_tokens
 
 
+def fast_pre_processing(document: str):
+    """
+    faster drop in for gist_pre_processing.  Punctuation and numbers are removed in a single regex
+    pass, after which almost every whitespace separated chunk is already a token.  Only the chunks
+    nltk's word tokenizer would split further (contractions, quotes, dashes) are handed to it, one
+    chunk at a time with the results cached
+    :param document: string
+    :return: cleaned tokens of the document, identical to gist_pre_processing's
+    """
+    clean_text = _CLEAN_PATTERN.sub(' ', document).lower()
+    return _SPLIT_PATTERN.sub(_split_chunk, clean_text).split()
+
+
+def _split_chunk(match):
+    # the whitespace either side of the chunk is passed along because some of the tokenizer's rules
+    # only fire next to a literal space
+    text, start, end = match.string, match.start(), match.end()
+    return _tokenize_chunk(text[start - 1:start], match.group(), text[end:end + 1])
+
+
+@lru_cache(maxsize=1 << 16)
+def _tokenize_chunk(before: str, chunk: str, after: str):
+    return ' '.join(_word_tokenizer.tokenize(before + chunk + after))
+
+
 def get_top_words(tokens: list, num: int):
     """
     returns a list of the top so many words that appear in the document
@@ -124,17 +302,17 @@ def filter_to_gist(tokens: list, words_to_keep: list):
     :param words_to_keep: list of tokens to keep
     :return: gist and tokenized gist
     """
-    gist_tokens = []
-    for word in tokens:
-        if word in words_to_keep:
-            gist_tokens.append(word)
+    words_to_keep = set(words_to_keep)
+    gist_tokens = [word for word in tokens if word in words_to_keep]
     gist = ' '.join(gist_tokens)
     return gist, gist_tokens
 
 
 def save_gist(directory: str, file_title: str, gist, extension: str = '.txt'):
     """
-    Wrapper around python's i/o to save the contents of the file
+    Wrapper around python's i/o to save the contents of the file.  The file is written under a
+    temporary name and then renamed so an interrupted run never leaves a partial gist behind that
+    would be skipped next time
     :param directory: place to save to
     :param file_title: title to give to the file
     :param gist: the data to save to the file
@@ -142,8 +320,16 @@ def save_gist(directory: str, file_title: str, gist, extension: str = '.txt'):
     :return:
     """
     file_path = os.path.join(directory, file_title) + extension
-    with open(file_path, 'w') as fp:
-        fp.write(gist)
+    # dot prefixed and not ending in .txt so the corpus readers never take it for a book
+    temp_path = os.path.join(directory, f'.{file_title}{extension}.tmp')
+    try:
+        with open(temp_path, 'w') as fp:
+            fp.write(gist)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 def gist_exists(directory: str, title: str, extension: str = '.txt'):
@@ -4,21 +4,42 @@ Module for recommending project gutenberg books
 """
 
 
+import os
 import pickle
 import sys
 import os.path as path
-import pandas as pd
-from gutenberg.query.api import get_metadata
-from sklearn.metrics import pairwise_distances
-import joblib
-from gensim.models import LdaMulticore
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+import numpy as np
 from typing import List
 
+import instrumentation
+from artifact_store import (add_artifacts, artifact_dir, artifacts_current, load_artifacts,
+                            load_corpus_matrix, save_artifacts)
+from metadata_index import MetadataIndex
+from neighbours import (RandomProjectionForest, TfidfReranker, exact_neighbours, normalize_rows,
+                        profile_vector, tfidf_matrix)
+from result_cache import RecommendationCache, cache_version
+# gensim, sklearn (through streaming_corpus) and joblib take seconds to import and are only needed
+# to build artifacts or load the model, so they are imported inside the functions that use them
+
 
 _CURRENT_MODEL = 'lda_30_topics.mdl'
 _CURRENT_CORPUS = 'iter_corpus.pkl'
 _CURRENT_TITLES = 'iter_topics.pkl'
 _RELATIVE_DIR = '../outputs/small_dataset_models'
+_ANN_INDEX_SUFFIX = '.ann.npz'
+_TFIDF_ARRAYS = ('tfidf_indptr', 'tfidf_indices', 'tfidf_data')
+_METADATA_INDEX = '../outputs/metadata.sqlite'
+_RESULT_CACHE = '../outputs/recommendation_cache.sqlite'
+_UNKNOWN = ':('
+_INFERENCE_CHUNK = 2000  # documents per get_document_topics batch
+_INFERENCE_SEED = 0  # chunks are seeded with this plus their first document's index
+
+_metadata_index = None
+_result_cache = None
+_cache_owner = None  # the resources tuple the result cache holds results for
+_worker_model = None  # the model of an inference worker process, set by its initializer
 
 
 def recommender(book_id: int = None, number_of_recommendations: int = None,
@@ -32,7 +53,7 @@ def recommender(book_id: int = None, number_of_recommendations: int = None,
     :return: the number of recommendations requested based upon the book
     """
     if not resources:
-        resources = load_resources()
+        resources = load_resources(serving_only=True)
     if not book_id:
         book_id = poll_user('What book did you like?\nid: ')
     starting_metadata = concat_metadata([book_id])
@@ -46,6 +67,7 @@ def recommender(book_id: int = None, number_of_recommendations: int = None,
     return recommendations
 
 
+@instrumentation.timed()
 def recommend(book_id, num_recs, resources = None):
     """
     manages creating the recommendation
@@ -56,93 +78,353 @@ def recommend(book_id, num_recs, resources = None):
     :return:
     """
     if not resources:
-        resources = load_resources()
-    model, corpus, ids, pg_id_to_ind, dist_mat = resources
-    ind = pg_id_to_ind[book_id]
-
-    trans_corpus = model.get_document_topics(corpus)
-    topic_weights = [doc for doc in trans_corpus]
-    doc_to_tops = topic_weights_to_matrix(topic_weights)
-
-    rec_ind = similar_ids(ind, doc_to_tops, num_recs, dist_mat)
-    rec_ids = [ids[ind] for ind in rec_ind]
+        resources = load_resources(serving_only=True)
+    model, corpus, ids, pg_id_to_ind, doc_topics, ann_index, reranker = resources
+    cache = _result_cache if resources is _cache_owner else None
+    rec_ids = cache.get(book_id, num_recs) if cache is not None else None
+    if rec_ids is None:
+        instrumentation.count('searches')
+        ind = pg_id_to_ind[book_id]
+        if reranker is None:
+            rec_ind = similar_ids(ind, doc_topics, num_recs, ann_index)
+        else:
+            shortlist = similar_ids(ind, doc_topics, max(reranker.shortlist, num_recs), ann_index)
+            rec_ind, _ = reranker.rerank(shortlist, doc_topics[ind], doc_topics,
+                                         reranker.query_vector([ind]), num_recs)
+        rec_ids = [int(ids[ind]) for ind in rec_ind]
+        if cache is not None:
+            cache.put(book_id, num_recs, rec_ids)
     recommendations = concat_metadata(rec_ids)
 
     return recommendations
 
 
-def load_resources():
+@instrumentation.timed()
+def recommend_profile(history: List[int], num_recs, resources=None, weights=None, exclude=()):
+    """
+    recommends from a reading history instead of a single book.  The topic rows of the books in
+    the history are averaged (optionally weighted) into a profile and the books closest to the
+    profile are returned, the search costs the same as a single book recommendation
+    :param history: gutenberg ids of the books read/liked, ids not in the corpus are ignored
+    :param num_recs: number of recommendations to make
+    :param resources: output of load_resources
+    :param weights: (optional) weight of each book in the history, e.g. ratings
+    :param exclude: (optional) gutenberg ids that must not be recommended, the history is always
+                    excluded
+    :return: list of tuples of book id, title, author, and  link to website
+    """
+    if not resources:
+        resources = load_resources(serving_only=True)
+    model, corpus, ids, pg_id_to_ind, doc_topics, ann_index, reranker = resources
+    if weights is None:
+        weights = [1] * len(history)
+    elif len(weights) != len(history):
+        raise ValueError(f'expected one weight per book ({len(history)}), got {len(weights)}')
+    known = [(pg_id_to_ind[book_id], weight) for book_id, weight in zip(history, weights)
+             if book_id in pg_id_to_ind]
+    if not known:
+        return []
+    inds, weights = zip(*known)
+    profile = profile_vector(doc_topics, inds, weights)
+    blocked = set(inds) | {pg_id_to_ind[book_id] for book_id in exclude if book_id in pg_id_to_ind}
+
+    num_candidates = num_recs if reranker is None else max(reranker.shortlist, num_recs)
+    if ann_index is not None:
+        rec_ind = ann_index.query(profile, num_candidates, exclude=blocked)
+    else:
+        rec_ind = exact_neighbours(profile, doc_topics, num_candidates, exclude=blocked)
+    if reranker is not None:
+        rec_ind, _ = reranker.rerank(rec_ind, profile, doc_topics,
+                                     reranker.query_vector(inds, weights), num_recs)
+    rec_ids = [int(ids[ind]) for ind in rec_ind]
+    return concat_metadata(rec_ids)
+
+
+@instrumentation.timed()
+def load_resources(approximate=False, cache_size=1024, persistent_cache=False,
+                   serving_only=False, hybrid_blend: float = None, shortlist: int = 200):
     """
     loads all of the serialize objects for the recommender to work.  Books identifies exist in
     realms: there is the gutenberg book id and the index where the book exsists in the corpus.
     These are not identical.
 
-    :return: model object, corpus vects object, list of gutenberg ids,
-             dictionary of book index number to id
+    Everything the recommender serves from lives in a memory mapped artifact directory beside the
+    model file (see artifact_store).  It is built from the pickled corpus and titles the first time
+    a model is used, or when the model file changes, so the whole corpus only has to be run through
+    the model once per model rather than once per recommendation.
+
+    Results of recommend() with the returned resources are kept in an LRU cache (see
+    result_cache.py) that is versioned by the artifact manifest, so it is dropped whenever the
+    model or the artifacts change.
+
+    :param approximate: if True an approximate nearest neighbour index is loaded (built and saved
+                        beside the model the first time) and used for recommendations
+    :param cache_size: number of results cached in memory, 0 disables the cache
+    :param persistent_cache: if True the cache is also stored in _RESULT_CACHE between runs
+    :param serving_only: if True only the arrays recommendations are made from are opened, model
+                         and corpus are None and gensim is never imported.  The model is still
+                         loaded if the artifacts have to be built first
+    :param hybrid_blend: (optional) weight of the tf-idf similarity when a shortlist of topic
+                         neighbours is reranked (see neighbours.TfidfReranker), None ranks by
+                         topics alone.  The tf-idf matrix is added to the artifacts the first time
+    :param shortlist: number of topic neighbours reranked in hybrid mode
+    :return: model object, corpus vects object, array of gutenberg ids,
+             dictionary of book index number to id, row normalized document to topic matrix,
+             approximate nearest neighbour index or None
+    """
+    model_path = path.join(_RELATIVE_DIR, _CURRENT_MODEL)
+    directory = artifact_dir(model_path)
+    if serving_only and artifacts_current(directory, model_path):
+        model = corpus = None
+        manifest, arrays = load_artifacts(directory, ['ids', 'unit_topics'])
+    else:
+        from gensim.matutils import Sparse2Corpus
+        from gensim.models import LdaMulticore
+
+        model = LdaMulticore.load(model_path)
+        manifest, arrays = load_model_artifacts(model, model_path)
+        corpus = Sparse2Corpus(load_corpus_matrix(manifest, arrays), documents_columns=False)
+        if serving_only:
+            model = corpus = None
+    ids = arrays['ids']
+    ids_to_ind_dict = {id_loop: ind_loop for ind_loop, id_loop in enumerate(ids.tolist())}
+    doc_topics = arrays['unit_topics']
+    ann_index = load_ann_index(doc_topics, model_path) if approximate else None
+    reranker = None
+    if hybrid_blend is not None:
+        manifest, tfidf = load_tfidf(directory, manifest)
+        reranker = TfidfReranker(tfidf, hybrid_blend, shortlist)
+    resources = model, corpus, ids, ids_to_ind_dict, doc_topics, ann_index, reranker
+    if cache_size:
+        reranking = None if reranker is None else [hybrid_blend, shortlist]
+        _bind_result_cache(resources, cache_version(manifest, approximate, reranking), cache_size,
+                           _RESULT_CACHE if persistent_cache else None)
+    return resources
+
+
+def load_tfidf(directory, manifest):
+    """
+    opens the tf-idf weighted corpus of an artifact directory, computing it from the stored
+    corpus and adding it to the directory first if it is not there yet
+    :param directory: artifact directory
+    :param manifest: its manifest dictionary
+    :return: the (possibly updated) manifest, scipy sparse csr (documents, terms) matrix
+    """
+    if not all(name in manifest['arrays'] for name in _TFIDF_ARRAYS):
+        _, arrays = load_artifacts(directory, ['corpus_indptr', 'corpus_indices', 'corpus_data'])
+        tfidf = tfidf_matrix(load_corpus_matrix(manifest, arrays))
+        manifest = add_artifacts(directory, manifest,
+                                 {'tfidf_indptr': tfidf.indptr, 'tfidf_indices': tfidf.indices,
+                                  'tfidf_data': tfidf.data})
+    _, arrays = load_artifacts(directory, _TFIDF_ARRAYS)
+    return manifest, load_corpus_matrix(manifest, arrays, 'tfidf')
+
+
+def _bind_result_cache(resources, version, cache_size, db_path):
+    """
+    points the result cache at a freshly loaded resources tuple.  The cached results are kept if
+    the artifacts are the same version, otherwise a new cache is started
+    :param resources: output of load_resources
+    :param version: see result_cache.cache_version
+    :param cache_size: number of results cached in memory
+    :param db_path: (optional) SQLite file backing the cache
+    :return: None
+    """
+    global _result_cache, _cache_owner
+    if _result_cache is None or (_result_cache.version, _result_cache.max_size,
+                                 _result_cache.db_path) != (version, cache_size, db_path):
+        if _result_cache is not None:
+            _result_cache.close()
+        _result_cache = RecommendationCache(version, cache_size, db_path)
+    _cache_owner = resources
+
+
+def load_model_artifacts(model, model_path):
+    """
+    opens the artifact directory of a model, building it first from the pickled corpus and titles
+    if it is missing or was built from a different model file
+    :param model: the lda model the artifacts belong to
+    :param model_path: location of the saved model
+    :return: manifest dictionary, dictionary of memory mapped arrays
+    """
+    from streaming_corpus import corpus_to_csr
+
+    directory = artifact_dir(model_path)
+    if not artifacts_current(directory, model_path):
+        corpus = _unpickle(path.join(_RELATIVE_DIR, _CURRENT_CORPUS))
+        ids = _unpickle(path.join(_RELATIVE_DIR, _CURRENT_TITLES))
+        doc_topics = build_doc_topics(model, corpus)
+        save_artifacts(directory, model_path,
+                       {'doc_topics': doc_topics, 'unit_topics': normalize_rows(doc_topics),
+                        'ids': np.array([int(id_loop) for id_loop in ids], dtype=np.int64)},
+                       corpus=corpus_to_csr(corpus), num_topics=model.num_topics)
+    return load_artifacts(directory)
+
+
+def load_ann_index(doc_topics, model_path, **kwargs):
+    """
+    loads the approximate nearest neighbour index for a model, building and saving it first if it
+    is missing, older than the model file, or built before books were appended to the artifacts
+    :param doc_topics: row normalized document to topic matrix
+    :param model_path: location of the saved model, the index is stored next to it
+    :param kwargs: passed to RandomProjectionForest when building
+    :return: RandomProjectionForest
+    """
+    index_path = model_path + _ANN_INDEX_SUFFIX
+    if path.isfile(index_path) and path.getmtime(index_path) >= path.getmtime(model_path):
+        ann_index = RandomProjectionForest.load(index_path, doc_topics)
+        # every tree holds every book once
+        if len(ann_index.leaf_items) == ann_index.num_trees * len(doc_topics):
+            return ann_index
+    ann_index = RandomProjectionForest(**kwargs).build(doc_topics)
+    ann_index.save(index_path)
+    return ann_index
+
+
+def result_cache_stats():
+    """
+    hit/miss counters of the result cache
+    :return: dictionary of counters or None if no cache was set up by load_resources
+    """
+    return _result_cache.stats() if _result_cache is not None else None
+
+
+@instrumentation.timed()
+def build_doc_topics(model, corpus, workers: int = None, chunksize: int = _INFERENCE_CHUNK):
+    """
+    runs the corpus through the model and fills a dense document to topic matrix.  Topics that
+    gensim leaves out of a document's output are left at zero.  The corpus is inferred in chunks,
+    when there is more than one chunk they are spread over a pool of processes which each get a
+    copy of the model once and send back the topic weights, which are scattered straight into the
+    chunk's rows of the matrix so no dense per chunk array is built or copied.  Inference of a
+    chunk starts from a random state seeded by the chunk's position, so the matrix is the same for
+    any number of workers (but depends on chunksize)
+    :param model: gensim lda model
+    :param corpus: gensim corpus (anything with a length that iterates bag of words documents)
+    :param workers: number of worker processes, defaults to the number of cpus, 1 infers in this
+                    process
+    :param chunksize: number of documents inferred at a time
+    :return: float32 numpy array of shape (documents, topics)
     """
-    model = LdaMulticore.load(path.join(_RELATIVE_DIR, _CURRENT_MODEL))
-    corpus = _unpickle(path.join(_RELATIVE_DIR, _CURRENT_CORPUS))
-    ids = _unpickle(path.join(_RELATIVE_DIR, _CURRENT_TITLES))
-    ids_to_ind_dict = {int(id_loop): ind_loop for ind_loop, id_loop in enumerate(ids)}
-    distance_mat_location = path.join(_RELATIVE_DIR, _CURRENT_MODEL + '.distance_matrix.pkl')
-    if path.isfile(distance_mat_location):
-        dist_mat = _unpickle(distance_mat_location, True)
+    doc_topics = np.zeros((len(corpus), model.num_topics), dtype=np.float32)
+    workers = workers or os.cpu_count()
+    chunks = _iter_chunks(corpus, chunksize)
+    if workers == 1 or len(corpus) <= chunksize:
+        for start, bows in chunks:
+            topic_weights_to_matrix(_infer(model, start, bows), out=doc_topics[start:])
     else:
-        dist_mat = None
-    return model, corpus, ids, ids_to_ind_dict, dist_mat
+        max_in_flight = 2 * workers
+        pending = set()
+        with ProcessPoolExecutor(workers, initializer=_init_inference_worker,
+                                 initargs=(model,)) as pool:
+            for start, bows in chunks:
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    _fill_finished(done, doc_topics)
+                pending.add(pool.submit(_infer_chunk, start, bows))
+            _fill_finished(wait(pending).done, doc_topics)
+    instrumentation.count('documents', len(doc_topics))
+    return doc_topics
+
+
+def _iter_chunks(corpus, chunksize):
+    documents = iter(corpus)
+    start = 0
+    while True:
+        bows = list(islice(documents, chunksize))
+        if not bows:
+            return
+        yield start, bows
+        start += len(bows)
+
+
+def _init_inference_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _infer_chunk(start, bows):
+    return start, _infer(_worker_model, start, bows)
 
 
-def similar_ids(document_index, doc_topics, num_recs=1, distance_mat=None):
+def _infer(model, start, bows):
+    # gensim draws the starting point of variational inference from model.random_state, a seed
+    # per chunk keeps the result independent of which process inferred which chunks
+    random_state = model.random_state
+    model.random_state = np.random.RandomState(_INFERENCE_SEED + start)
+    try:
+        # plain floats pickle far smaller than the numpy scalars gensim returns
+        return [[(topic, float(weight)) for topic, weight in doc]
+                for doc in model.get_document_topics(bows)]
+    finally:
+        model.random_state = random_state
+
+
+def _fill_finished(futures, doc_topics):
+    for future in futures:
+        start, topic_weights = future.result()  # re-raises any exception from the worker
+        topic_weights_to_matrix(topic_weights, out=doc_topics[start:])
+
+
+def similar_ids(document_index, doc_topics, num_recs=1, ann_index=None):
     """
-    This function calculates distances to minimize for the recommendation
+    This function finds the closest books by cosine distance for the recommendation.  Only the
+    distances from the query book are calculated so no N x N distance matrix is ever built
     :param document_index: the index of the book from which the recommendation is based [index not
                            gutenberg id]
-    :param doc_topics: document topics matrix
+    :param doc_topics: row normalized document topics matrix (see normalize_rows)
     :param num_recs: how many recomendations to make
+    :param ann_index: (optional) approximate nearest neighbour index, if provided it is searched
+                      instead of the whole matrix
     :return: a list of the recommendations
     """
-    if distance_mat is None:
-        pkl_local = path.join(_RELATIVE_DIR, _CURRENT_MODEL + '.distance_matrix.pkl')
-        if path.isfile(pkl_local):
-            distance_mat = _unpickle(pkl_local, True)
-        else:
-            distance_mat = pairwise_distances(doc_topics.values, metric='cosine')
-            _pickle(pkl_local, distance_mat, True)
-    recs = distance_mat[document_index].argsort()
-    return recs[1:1 + num_recs]
+    query = doc_topics[document_index]
+    if ann_index is not None:
+        return ann_index.query(query, num_recs, exclude=[document_index])
+    return exact_neighbours(query, doc_topics, num_recs, exclude=[document_index])
 
 
-def topic_weights_to_matrix(topic_weights, doc_ids=None, topic_ids=None):
+def topic_weights_to_matrix(topic_weights, num_topics: int = None, out=None):
     """
-    converts the output of gensim topic weights to a proper document to topic matrix
+    converts the output of gensim topic weights to a proper document to topic matrix.  The weights
+    are flattened into index and value arrays and scattered into the matrix in one assignment,
+    topics missing from a document's output stay zero
     :param topic_weights: List[List[Tuples[Topic, Topic Probability]]]
-    :param doc_ids: (optional) list of document titles/ids in the same order as the topic_weights
-                    if provided this will change the index to the document titles/ids
-    :param topic_ids: (optional) list of topic names. if provided this will change the columns to
-                      the topic names
-    :return: panda data frame of the document to topic matrix
+    :param num_topics: number of columns, defaults to the highest topic seen + 1
+    :param out: (optional) preallocated zeroed array whose first rows are filled instead of a new
+                array
+    :return: float32 numpy array of shape (documents, topics), or the filled rows of out
     """
-    topic_dicts = [dict(doc) for doc in topic_weights]
-    doc_to_top_mat = pd.DataFrame(topic_dicts).fillna(0)
-    if doc_ids:
-        doc_to_top_mat.rename(index=lambda ind: doc_ids[ind], inplace=True)
-    if topic_ids:
-        doc_to_top_mat.rename(columns=lambda ind: topic_ids[ind], inplace=True)
-    return doc_to_top_mat
+    topic_weights = list(topic_weights)  # gensim hands back a lazily transformed corpus
+    lengths = np.fromiter((len(doc) for doc in topic_weights), dtype=np.int64,
+                          count=len(topic_weights))
+    pairs = np.fromiter((value for doc in topic_weights for pair in doc for value in pair),
+                        dtype=np.float64, count=2 * int(lengths.sum()))
+    rows = np.repeat(np.arange(len(topic_weights)), lengths)
+    topics, weights = pairs[0::2].astype(np.int64), pairs[1::2]
+    if out is None:
+        num_topics = num_topics or (int(topics.max()) + 1 if len(topics) else 0)
+        out = np.zeros((len(topic_weights), num_topics), dtype=np.float32)
+    else:
+        out = out[:len(topic_weights)]
+    out[rows, topics] = weights
+    return out
 
 
+@instrumentation.timed()
 def concat_metadata(ids: List[int]):
     """
-    compiles the metadata from a book id
+    compiles the metadata from a book id.  All of the ids are looked up in the local metadata
+    index with a single batched query
     :param ids: list of gutenberg ids to fetch metadata form
     :return: list of tuples of book id, title, author, and  link to website
     """
+    found = _lookup_metadata(ids)
     metadata = []
     for book_id in ids:
-        title = get_title(book_id)
-        author = get_author(book_id)
+        title, author, *_ = found.get(book_id, (_UNKNOWN, _UNKNOWN))
         link = f'https://www.gutenberg.org/ebooks/{book_id}'
-        metadata.append((book_id, title, author, link))
+        metadata.append((book_id, _clean_attr(title), _clean_attr(author), link))
     return metadata
 
 
@@ -166,14 +448,33 @@ def get_author(book_id):
 
 def _get_attr(book_id: int, attr: str):
     """
-    interface with the gutenberg python library.  The library returns frozen sets so this code
-    extracts the attributes and returns them as a string
+    looks a single attribute up in the local metadata index (see metadata_index.py)
     :param book_id: gutenbern id
-    :param attr:
-    :return:
+    :param attr: title, author, or language
+    :return: the attribute as a string
     """
-    # res, *bla = get_metadata(attr, book_id)
-    res = ':('
+    found = _lookup_metadata([book_id])
+    if book_id not in found:
+        return _UNKNOWN
+    title, author, language, subjects = found[book_id]
+    return _clean_attr({'title': title, 'author': author, 'language': language}[attr])
+
+
+def _lookup_metadata(ids):
+    """
+    batched lookup in the metadata index, the index is opened on first use and kept open
+    :param ids: gutenberg ids
+    :return: dictionary of id to (title, author, language, subjects)
+    """
+    global _metadata_index
+    if _metadata_index is None:
+        if not path.isfile(_METADATA_INDEX):
+            return {}
+        _metadata_index = MetadataIndex(_METADATA_INDEX)
+    return _metadata_index.lookup(ids)
+
+
+def _clean_attr(res):
     res = res.split('\n')[0]
     if len(res) > 50:
         res = res[:50]
@@ -183,6 +484,7 @@ def _get_attr(book_id: int, attr: str):
 def _unpickle(file_path, use_joblib=False):
     with open(file_path, 'rb') as fp:
         if use_joblib:
+            import joblib
             return joblib.load(fp)
         return pickle.load(fp)
 
@@ -190,6 +492,7 @@ def _unpickle(file_path, use_joblib=False):
 def _pickle(file_path, obj, use_joblib=False):
     with open(file_path, 'wb') as fp:
         if use_joblib:
+            import joblib
             joblib.dump(obj, fp)
         else:
             pickle.dump(obj, fp)
@@ -251,7 +554,7 @@ def main():
     :return:
     """
     print_directions()
-    resources = load_resources()
+    resources = load_resources(serving_only=True)
     # allows sys args
     args = [int(arg) for arg in sys.argv[1:]]
     while True:
@@ -0,0 +1,167 @@
+"""
+Bounded LRU cache of recommendation results
+
+Traffic is heavily skewed towards a few hundred popular books, so the recommended ids of every
+(book id, number of recommendations) query are kept in memory and the least recently used entries
+are dropped once the cache is full.  The cache can also be backed by a SQLite file so the results
+survive restarts, new results are written to it in batches outside the lock of the in memory
+entries and the rest on close() (also run at exit).
+
+Every entry belongs to a version, a hash of the artifact manifest (which records the model's hash
+and the shape of every array).  Retraining the model, switching _CURRENT_MODEL or appending books
+to the artifacts gives a new version, and entries of any other version are never returned and are
+deleted from the file when it is opened.
+"""
+
+
+import atexit
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS recommendations (
+                 version TEXT,
+                 book_id INTEGER,
+                 k INTEGER,
+                 rec_ids TEXT,
+                 PRIMARY KEY (version, book_id, k))'''
+_WRITE_BATCH = 64  # new results written to the SQLite file per transaction
+
+
+def cache_version(manifest: dict, approximate: bool = False, reranking=None):
+    """
+    the version results computed from an artifact directory are stored under
+    :param manifest: manifest dictionary of the artifact directory
+    :param approximate: whether the results come from the approximate index, they can differ from
+                        the exact results so they are versioned separately
+    :param reranking: (optional) json serializable settings of the hybrid reranking, results of
+                      every setting are versioned separately
+    :return: hex digest
+    """
+    key = json.dumps([manifest, approximate, reranking], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class RecommendationCache:
+    """
+    Thread safe LRU cache of (book id, k) -> recommended gutenberg ids with hit/miss counters.
+    Only the ids are cached, the metadata is looked up again on every call so a rebuilt metadata
+    index is picked up straight away.
+    """
+
+    def __init__(self, version: str, max_size: int = 1024, db_path: str = None):
+        """
+        :param version: see cache_version
+        :param max_size: number of entries kept in memory
+        :param db_path: (optional) SQLite file persisting the entries between runs
+        """
+        self.version = version
+        self.max_size = max_size
+        self.db_path = db_path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # lock guards the in memory entries and counters, db_lock the connection, so lookups are
+        # never held up by disk I/O
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.unwritten = []
+        self.conn = None
+        if db_path:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            with self.conn:
+                self.conn.execute(_SCHEMA)
+                self.conn.execute('DELETE FROM recommendations WHERE version != ?', (version,))
+            atexit.register(self.close)
+
+    def get(self, book_id: int, k: int):
+        """
+        :param book_id: gutenberg id of the query book
+        :param k: number of recommendations
+        :return: list of recommended gutenberg ids or None on a miss
+        """
+        key = (book_id, k)
+        with self.lock:
+            rec_ids = self.entries.get(key)
+            if rec_ids is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(rec_ids)
+        rec_ids = self._read(book_id, k)
+        with self.lock:
+            if rec_ids is None:
+                self.misses += 1
+                return None
+            self._remember(key, rec_ids)
+            self.hits += 1
+            return list(rec_ids)
+
+    def put(self, book_id: int, k: int, rec_ids):
+        """
+        :param book_id: gutenberg id of the query book
+        :param k: number of recommendations
+        :param rec_ids: recommended gutenberg ids
+        :return: None
+        """
+        rec_ids = [int(rec_id) for rec_id in rec_ids]
+        with self.lock:
+            self._remember((book_id, k), rec_ids)
+            if self.conn is None:
+                return
+            self.unwritten.append((self.version, int(book_id), int(k), json.dumps(rec_ids)))
+            if len(self.unwritten) < _WRITE_BATCH:
+                return
+            rows, self.unwritten = self.unwritten, []
+        self._write(rows)
+
+    def flush(self):
+        """
+        writes the results not yet in the SQLite file
+        :return: None
+        """
+        with self.lock:
+            rows, self.unwritten = self.unwritten, []
+        self._write(rows)
+
+    def _read(self, book_id, k):
+        with self.db_lock:
+            if self.conn is None:
+                return None
+            row = self.conn.execute('SELECT rec_ids FROM recommendations '
+                                    'WHERE version = ? AND book_id = ? AND k = ?',
+                                    (self.version, int(book_id), int(k))).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _write(self, rows):
+        with self.db_lock:
+            if not rows or self.conn is None:
+                return
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO recommendations VALUES (?, ?, ?, ?)',
+                                      rows)
+
+    def stats(self):
+        """
+        :return: dictionary of the counters and the current size
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.,
+                    'size': len(self.entries), 'max_size': self.max_size}
+
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            with self.db_lock:
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+
+    def _remember(self, key, rec_ids):
+        self.entries[key] = rec_ids
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
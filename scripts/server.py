@@ -0,0 +1,166 @@
+"""
+Local HTTP/JSON recommendation service
+
+A small asyncio server using only the standard library.  The recommender's resources are loaded
+once at start up and stay warm, requests are handled concurrently and the CPU bound search and
+metadata lookups run in a thread pool so they never block the event loop.
+
+    $ python server.py [port]
+
+Endpoints:
+    GET /recommend?id=174&k=5        recommendations for a book
+    GET /metadata?id=174,1342        metadata of one or more books
+    GET /metrics                     request counts and latency histograms per endpoint and the
+                                     result cache's hit/miss counters
+"""
+
+
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from sys import argv
+from urllib.parse import parse_qs, urlsplit
+
+from recommender import concat_metadata, load_resources, recommend, result_cache_stats
+
+# upper bounds of the latency histogram buckets in milliseconds
+_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+_MAX_RECOMMENDATIONS = 100
+_METADATA_FIELDS = ('id', 'title', 'author', 'link')
+
+
+class LatencyHistogram:
+    """
+    fixed bucket latency histogram, only ever updated from the event loop thread
+    """
+
+    def __init__(self, buckets=_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total_ms = 0.
+
+    def observe(self, milliseconds):
+        self.count += 1
+        self.total_ms += milliseconds
+        for ind, bound in enumerate(self.buckets):
+            if milliseconds <= bound:
+                self.counts[ind] += 1
+                break
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean_ms': self.total_ms / self.count if self.count else 0.,
+                'buckets_ms': {str(bound): count for bound, count in zip(self.buckets, self.counts)}}
+
+
+class RecommendationServer:
+    """
+    holds the warm resources, the thread pool and the metrics of the service
+    """
+
+    def __init__(self, resources=None, threads=None):
+        self.resources = resources or load_resources(serving_only=True)
+        model, corpus, ids, self.pg_id_to_ind, doc_topics, ann_index, reranker = self.resources
+        self.pool = ThreadPoolExecutor(threads)
+        self.histograms = {}
+        self.routes = {'/recommend': self.handle_recommend, '/metadata': self.handle_metadata,
+                       '/metrics': self.handle_metrics}
+
+    async def handle_connection(self, reader, writer):
+        """
+        serves a single http request, the connection is closed afterwards
+        """
+        start = time.perf_counter()
+        route = None
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # headers are not needed
+            if len(request_line) != 3 or request_line[0] != 'GET':
+                status, body = HTTPStatus.METHOD_NOT_ALLOWED, {'error': 'only GET is supported'}
+            else:
+                url = urlsplit(request_line[1])
+                route = url.path
+                handler = self.routes.get(route)
+                if handler is None:
+                    status, body = HTTPStatus.NOT_FOUND, {'error': f'unknown path {route}'}
+                else:
+                    status, body = await handler(parse_qs(url.query))
+        except Exception as error:  # a bad request must not take the server down
+            logging.exception('request failed')
+            status, body = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(error)}
+
+        payload = json.dumps(body).encode()
+        writer.write(f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                     f'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(payload)}\r\n'
+                     f'Connection: close\r\n\r\n'.encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+        if route in self.routes:
+            self.histograms.setdefault(route, LatencyHistogram()).observe(
+                (time.perf_counter() - start) * 1000)
+
+    async def handle_recommend(self, query):
+        try:
+            book_id = int(query['id'][0])
+            num_recs = int(query.get('k', ['5'])[0])
+        except (KeyError, ValueError):
+            return HTTPStatus.BAD_REQUEST, {'error': 'id and k must be integers'}
+        if not 0 < num_recs <= _MAX_RECOMMENDATIONS:
+            return HTTPStatus.BAD_REQUEST, {'error': f'k must be between 1 and '
+                                                     f'{_MAX_RECOMMENDATIONS}'}
+        if book_id not in self.pg_id_to_ind:
+            return HTTPStatus.NOT_FOUND, {'error': f'{book_id} is not in the corpus'}
+        recommendations = await self.run(recommend, book_id, num_recs, self.resources)
+        return HTTPStatus.OK, {'id': book_id, 'k': num_recs,
+                               'recommendations': [dict(zip(_METADATA_FIELDS, entry))
+                                                   for entry in recommendations]}
+
+    async def handle_metadata(self, query):
+        try:
+            book_ids = [int(book_id) for book_id in ','.join(query['id']).split(',')]
+        except (KeyError, ValueError):
+            return HTTPStatus.BAD_REQUEST, {'error': 'id must be a comma separated list of integers'}
+        metadata = await self.run(concat_metadata, book_ids)
+        return HTTPStatus.OK, {'books': [dict(zip(_METADATA_FIELDS, entry)) for entry in metadata]}
+
+    async def handle_metrics(self, query):
+        metrics = {route: histogram.to_dict() for route, histogram in self.histograms.items()}
+        metrics['result_cache'] = result_cache_stats()
+        return HTTPStatus.OK, metrics
+
+    async def run(self, func, *args):
+        """
+        runs blocking work in the thread pool
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+
+async def serve(host='127.0.0.1', port=8000, resources=None):
+    """
+    loads the resources and serves until cancelled
+    :param host: interface to listen on
+    :param port: port to listen on
+    :param resources: (optional) output of recommender.load_resources
+    :return: None
+    """
+    app = RecommendationServer(resources)
+    server = await asyncio.start_server(app.handle_connection, host, port)
+    logging.info(f'serving recommendations on http://{host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(port=int(argv[1]) if argv[1:] else 8000))
+    except KeyboardInterrupt:
+        print('\nquitting')
@@ -0,0 +1,221 @@
+"""
+Out of core vectorization of the gist corpus
+
+stream_vectorize() reads documents one at a time and writes the document term matrix to disk in
+CSR chunks, so the corpus never has to fit in memory:
+
+    <output dir>/
+        streamed.json           number of documents/terms/chunks and the vectorizing options
+        titles.txt              one document title (gutenberg id) per line, in corpus order
+        id2word.json            term id -> word
+        doc_term_00000.npz      scipy sparse CSR (documents, terms) chunks
+        doc_term_00001.npz
+        ...
+
+StreamedCorpus reads those chunks back as a gensim compatible corpus (an iterable of bag of words
+documents that can be iterated over once per training pass).
+"""
+
+
+import json
+import logging
+import os
+import os.path as path
+import shutil
+import zlib
+from collections import Counter
+from sys import argv
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+
+_META = 'streamed.json'
+_TITLES = 'titles.txt'
+_ID2WORD = 'id2word.json'
+_CHUNK = 'doc_term_{:05d}.npz'
+
+
+def stream_vectorize(documents, output_dir: str, chunk_size: int = 1000, hashing: bool = False,
+                     n_features: int = 2 ** 18, **kwargs):
+    """
+    vectorizes documents as they are read.  Tokens are found with the same analyzer as
+    fit_vectorizer's CountVectorizer.  Without hashing the vocabulary is built up as new words are
+    seen, with hashing a word's column is crc32(word) % n_features so no vocabulary has to be kept
+    to vectorize and a reverse map is stored for id2word
+    :param documents: iterable of (title, text) tuples e.g. pre_processing.iter_corpus
+    :param output_dir: directory to write the chunks to
+    :param chunk_size: number of documents per chunk
+    :param hashing: whether to use feature hashing instead of a growing vocabulary
+    :param n_features: number of hash buckets when hashing
+    :param kwargs: passed to CountVectorizer to build the analyzer, stop_words defaults to english
+    :return: StreamedCorpus over the written chunks
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    kwargs.setdefault('stop_words', 'english')
+    analyzer = CountVectorizer(**kwargs).build_analyzer()
+    vocabulary = {}
+    id2word = {}
+    num_docs = num_chunks = 0
+    rows = []
+    with open(path.join(output_dir, _TITLES), 'w') as titles:
+        for title, text in documents:
+            counts = Counter(analyzer(text))
+            if hashing:
+                columns = [zlib.crc32(word.encode()) % n_features for word in counts]
+                for column, word in zip(columns, counts):
+                    id2word.setdefault(column, word)
+            else:
+                columns = [vocabulary.setdefault(word, len(vocabulary)) for word in counts]
+            rows.append((columns, list(counts.values())))
+            titles.write(f'{title}\n')
+            num_docs += 1
+            if len(rows) >= chunk_size:
+                _save_chunk(output_dir, num_chunks, rows)
+                num_chunks += 1
+                rows = []
+                logging.debug(f'{num_docs} documents vectorized')
+        if rows:
+            _save_chunk(output_dir, num_chunks, rows)
+            num_chunks += 1
+
+    if not hashing:
+        id2word = {column: word for word, column in vocabulary.items()}
+    num_terms = n_features if hashing else len(vocabulary)
+    with open(path.join(output_dir, _ID2WORD), 'w') as fp:
+        json.dump(id2word, fp)
+    with open(path.join(output_dir, _META), 'w') as fp:
+        json.dump({'num_docs': num_docs, 'num_terms': num_terms, 'num_chunks': num_chunks,
+                   'hashing': hashing}, fp)
+    logging.info(f'{num_docs} documents, {len(id2word)} terms written to {output_dir}')
+    return StreamedCorpus(output_dir)
+
+
+class StreamedCorpus:
+    """
+    gensim compatible corpus backed by the CSR chunks written by stream_vectorize.  Only one chunk
+    is in memory at a time, iterating again re-reads the chunks from disk
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(path.join(directory, _META)) as fp:
+            meta = json.load(fp)
+        self.num_docs = meta['num_docs']
+        self.num_terms = meta['num_terms']
+        self.num_chunks = meta['num_chunks']
+        self.hashing = meta['hashing']
+
+    def __len__(self):
+        return self.num_docs
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            for ind in range(chunk.shape[0]):
+                start, end = chunk.indptr[ind], chunk.indptr[ind + 1]
+                yield list(zip(chunk.indices[start:end].tolist(), chunk.data[start:end].tolist()))
+
+    def iter_chunks(self):
+        """
+        :return: generator of scipy sparse CSR (documents, terms) chunks, all num_terms wide
+        """
+        for chunk_num in range(self.num_chunks):
+            chunk = sparse.load_npz(path.join(self.directory, _CHUNK.format(chunk_num)))
+            chunk.resize((chunk.shape[0], self.num_terms))
+            yield chunk
+
+    def to_csr(self):
+        """
+        :return: the whole document term matrix as one scipy sparse CSR matrix
+        """
+        return sparse.vstack(list(self.iter_chunks()), format='csr')
+
+    def titles(self):
+        """
+        :return: list of document titles in corpus order
+        """
+        with open(path.join(self.directory, _TITLES)) as fp:
+            return fp.read().split('\n')[:-1]
+
+    def id2word(self):
+        """
+        :return: dictionary of term id to word
+        """
+        with open(path.join(self.directory, _ID2WORD)) as fp:
+            return {int(column): word for column, word in json.load(fp).items()}
+
+    def select_terms(self, columns, output_dir: str):
+        """
+        writes a copy of the corpus that only has the given terms, renumbered in the order given
+        :param columns: term ids to keep
+        :param output_dir: directory for the new corpus, must not be this corpus' directory
+        :return: StreamedCorpus over the new directory
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        columns = np.asarray(columns, dtype=np.int64)
+        for chunk_num, chunk in enumerate(self.iter_chunks()):
+            sparse.save_npz(path.join(output_dir, _CHUNK.format(chunk_num)), chunk[:, columns])
+        shutil.copyfile(path.join(self.directory, _TITLES), path.join(output_dir, _TITLES))
+        id2word = self.id2word()
+        with open(path.join(output_dir, _ID2WORD), 'w') as fp:
+            json.dump({new: id2word[old] for new, old in enumerate(columns.tolist())
+                       if old in id2word}, fp)
+        with open(path.join(output_dir, _META), 'w') as fp:
+            json.dump({'num_docs': self.num_docs, 'num_terms': len(columns),
+                       'num_chunks': self.num_chunks, 'hashing': False}, fp)
+        return StreamedCorpus(output_dir)
+
+
+def vectorize_with_vocabulary(texts, id2word: dict, num_terms: int = None, **kwargs):
+    """
+    vectorizes documents against an existing vocabulary, words the vocabulary does not have are
+    dropped.  Used to map new books into the vocabulary of an already trained model
+    :param texts: iterable of document strings
+    :param id2word: dictionary (or gensim Dictionary) of term id to word
+    :param num_terms: width of the matrix, defaults to the largest term id + 1
+    :param kwargs: passed to CountVectorizer to build the analyzer, stop_words defaults to english
+    :return: scipy sparse CSR (documents, terms) matrix
+    """
+    kwargs.setdefault('stop_words', 'english')
+    analyzer = CountVectorizer(**kwargs).build_analyzer()
+    word2id = {word: column for column, word in id2word.items()}
+    rows = []
+    for text in texts:
+        counts = Counter(word for word in analyzer(text) if word in word2id)
+        rows.append(([word2id[word] for word in counts], list(counts.values())))
+    num_terms = num_terms or max(word2id.values()) + 1
+    return _rows_to_csr(rows, num_terms)
+
+
+def corpus_to_csr(corpus):
+    """
+    gets the (documents, terms) matrix out of either corpus type the training code produces
+    :param corpus: gensim Sparse2Corpus or StreamedCorpus
+    :return: scipy sparse CSR matrix
+    """
+    if isinstance(corpus, StreamedCorpus):
+        return corpus.to_csr()
+    return sparse.csr_matrix(corpus.sparse.T)
+
+
+def _save_chunk(output_dir, chunk_num, rows):
+    sparse.save_npz(path.join(output_dir, _CHUNK.format(chunk_num)), _rows_to_csr(rows))
+
+
+def _rows_to_csr(rows, num_columns=None):
+    indptr = np.cumsum([0] + [len(columns) for columns, counts in rows])
+    indices = np.fromiter((column for columns, counts in rows for column in columns),
+                          dtype=np.int32, count=indptr[-1])
+    data = np.fromiter((count for columns, counts in rows for count in counts),
+                       dtype=np.float32, count=indptr[-1])
+    if num_columns is None:
+        num_columns = int(indices.max()) + 1 if len(indices) else 0
+    matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(rows), num_columns))
+    matrix.sum_duplicates()  # hashed words can collide
+    return matrix
+
+
+if __name__ == '__main__':
+    # python streaming_corpus.py <gist directory> <output directory>
+    from pre_processing import iter_corpus
+    stream_vectorize(iter_corpus(argv[1]), argv[2])
@@ -1,30 +1,218 @@
+"""
+Removes the project gutenberg headers and footers from the raw text files
+
+The files are streamed line by line: the markers are found while scanning, the kept lines are
+written to a temporary file which then replaces the original, so memory use does not depend on the
+size of the book and an interrupted run never leaves a half written file.  The rules are the ones
+of the gutenberg library's strip_headers, which needed the whole book in memory.
+
+    $ python strip_headers.py <directory> [extension] [workers]
+"""
+
+
+import csv
+import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 from sys import argv
-import logging
-from gutenberg.cleanup.strip_headers import strip_headers
+from typing import Iterable
 
+# marker lists from the gutenberg library (gutenberg/_domain_model/text.py)
+_TEXT_START_MARKERS = (
+    '*END*THE SMALL PRINT',
+    '*** START OF THE PROJECT GUTENBERG',
+    '*** START OF THIS PROJECT GUTENBERG',
+    'This etext was prepared by',
+    'E-text prepared by',
+    'Produced by',
+    'Distributed Proofreading Team',
+    'Proofreading Team at http://www.pgdp.net',
+    'http://gallica.bnf.fr)',
+    '      http://archive.org/details/',
+    'http://www.pgdp.net',
+    'by The Internet Archive)',
+    'by The Internet Archive/Canadian Libraries',
+    'by The Internet Archive/American Libraries',
+    'public domain material from the Internet Archive',
+    'Internet Archive)',
+    'Internet Archive/Canadian Libraries',
+    'Internet Archive/American Libraries',
+    'material from the Google Print project',
+    '*END THE SMALL PRINT',
+    '***START OF THE PROJECT GUTENBERG',
+    'This etext was produced by',
+    '*** START OF THE COPYRIGHTED',
+    'The Project Gutenberg',
+    'http://gutenberg.spiegel.de/ erreichbar.',
+    'Project Runeberg publishes',
+    'Beginning of this Project Gutenberg',
+    'Project Gutenberg Online Distributed',
+    'Gutenberg Online Distributed',
+    'the Project Gutenberg Online Distributed',
+    'Project Gutenberg TEI',
+    'This eBook was prepared by',
+    'http://gutenberg2000.de erreichbar.',
+    'This Etext was prepared by',
+    'This Project Gutenberg Etext was prepared by',
+    'Gutenberg Distributed Proofreaders',
+    'Project Gutenberg Distributed Proofreaders',
+    'the Project Gutenberg Online Distributed Proofreading Team',
+    '**The Project Gutenberg',
+    '*SMALL PRINT!',
+    'More information about this book is at the top of this file.',
+    'tells you about restrictions in how the file may be used.',
+    "l'authorization à les utilizer pour preparer ce texte.",
+    'of the etext through OCR.',
+    '*****These eBooks Were Prepared By Thousands of Volunteers!*****',
+    'We need your donations more than ever!',
+    ' *** START OF THIS PROJECT GUTENBERG',
+    '****     SMALL PRINT!',
+    '["Small Print" V.',
+    '      (http://www.ibiblio.org/gutenberg/',
+    'and the Project Gutenberg Online Distributed Proofreading Team',
+    'Mary Meehan, and the Project Gutenberg Online Distributed Proofreading',
+    '                this Project Gutenberg edition.',
+)
+_TEXT_END_MARKERS = (
+    '*** END OF THE PROJECT GUTENBERG',
+    '*** END OF THIS PROJECT GUTENBERG',
+    '***END OF THE PROJECT GUTENBERG',
+    'End of the Project Gutenberg',
+    'End of The Project Gutenberg',
+    'Ende dieses Project Gutenberg',
+    'by Project Gutenberg',
+    'End of Project Gutenberg',
+    'End of this Project Gutenberg',
+    'Ende dieses Projekt Gutenberg',
+    '        ***END OF THE PROJECT GUTENBERG',
+    '*** END OF THE COPYRIGHTED',
+    'End of this is COPYRIGHTED',
+    'Ende dieses Etextes ',
+    'Ende dieses Project Gutenber',
+    'Ende diese Project Gutenberg',
+    '**This is a COPYRIGHTED Project Gutenberg Etext, Details Above**',
+    'Fin de Project Gutenberg',
+    'The Project Gutenberg Etext of ',
+    'Ce document fut presente en lecture',
+    'Ce document fut présenté en lecture',
+    'More information about this book is at the top of this file.',
+    'We need your donations more than ever!',
+    'END OF PROJECT GUTENBERG',
+    ' End of the Project Gutenberg',
+    ' *** END OF THIS PROJECT GUTENBERG',
+)
+_LEGALESE_START_MARKERS = ('<<THIS ELECTRONIC VERSION OF',)
+_LEGALESE_END_MARKERS = ('SERVICE THAT CHARGES FOR DOWNLOAD',)
+# a start marker may only appear in the first _HEADER_LINES kept lines and an end marker only
+# after the first _FOOTER_LINES, so at most _HEADER_LINES lines are ever held back
+_HEADER_LINES = 600
+_FOOTER_LINES = 100
 
-def strip_headers_dir(directory: str = './', extension: str = '.txt'):
-    for item in os.listdir(directory):
-        if item.endswith(extension):
-            path = os.path.join(directory, item)
-            try:
-                # there seem to be a number of odd characters that were mis-encoded so setting
-                # errors to ignore will leave those characters out. The files are supposed to ascii
-                # but there seems to be a few that are not
-                with open(path, 'r+', errors='ignore') as file:
-                    text = file.read()
 
-            except IsADirectoryError:
-                logging.debug(f'{item} is a directory')
+def strip_headers_dir(directory: str = './', extension: str = '.txt', workers: int = None,
+                      report_path: str = None):
+    """
+    strips every file in the directory in place, across a pool of processes
+    :param directory: directory of raw text files
+    :param extension: only files ending in this are stripped
+    :param workers: number of worker processes, defaults to the number of cpus
+    :param report_path: (optional) csv to write the byte counts of every file to
+    :return: dictionary of file path to (bytes before, bytes after)
+    """
+    with os.scandir(directory) as entries:
+        file_paths = [entry.path for entry in entries
+                      if entry.name.endswith(extension) and entry.is_file()]
+    with ProcessPoolExecutor(workers) as pool:
+        byte_counts = dict(zip(file_paths, pool.map(strip_headers_file, file_paths,
+                                                    chunksize=16)))
+    for file_path, (bytes_in, bytes_out) in byte_counts.items():
+        logging.debug(f'{file_path} truncated from {bytes_in} to {bytes_out} bytes')
+    total_in = sum(bytes_in for bytes_in, _ in byte_counts.values())
+    total_out = sum(bytes_out for _, bytes_out in byte_counts.values())
+    logging.info(f'{len(byte_counts)} files stripped from {total_in} to {total_out} bytes')
+    if report_path:
+        with open(report_path, 'w', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(['file', 'bytes_in', 'bytes_out'])
+            writer.writerows((file_path, *counts) for file_path, counts in byte_counts.items())
+    return byte_counts
 
+
+def strip_headers_file(file_path: str, output_path: str = None):
+    """
+    strips a single file, by default in place
+    :param file_path: location of the raw text file
+    :param output_path: (optional) location to write to instead
+    :return: bytes before, bytes after
+    """
+    output_path = output_path or file_path
+    # dot prefixed and not ending in .txt so the corpus readers never take it for a book
+    directory, name = os.path.split(output_path)
+    temp_path = os.path.join(directory, f'.{name}.tmp')
+    bytes_in = os.path.getsize(file_path)
+    try:
+        # there seem to be a number of odd characters that were mis-encoded so setting errors to
+        # ignore will leave those characters out. The files are supposed to ascii but there seems
+        # to be a few that are not
+        with open(file_path, 'r', errors='ignore') as source, open(temp_path, 'w') as target:
+            write_lines(strip_lines(source), target)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+    return bytes_in, os.path.getsize(output_path)
+
+
+def strip_lines(lines: Iterable[str]):
+    """
+    streaming version of gutenberg's strip_headers.  Everything up to the last start marker within
+    the header is dropped, as is everything from the first end marker after it and any legalese
+    section in between.  Like the original, a start marker does not reset the count of kept lines
+    :param lines: lines of the book, with or without their line endings
+    :return: generator of the kept lines without line endings
+    """
+    held = []  # kept lines that a later start marker could still discard
+    kept = 0
+    ignore_section = False
+    for chunk in lines:
+        for line in chunk.splitlines():
+            if kept <= _HEADER_LINES and line.startswith(_TEXT_START_MARKERS):
+                held = []
+                continue
+            if kept >= _FOOTER_LINES and line.startswith(_TEXT_END_MARKERS):
+                yield from held
+                return
+            if line.startswith(_LEGALESE_START_MARKERS):
+                ignore_section = True
+                continue
+            if line.startswith(_LEGALESE_END_MARKERS):
+                ignore_section = False
+                continue
+            if ignore_section:
+                continue
+            kept += 1
+            if kept <= _HEADER_LINES:
+                held.append(line)
             else:
-                clean_text = strip_headers(text)
-                with open(path, 'r+') as file:
-                    file.write(clean_text)
-                    file.truncate()
-                logging.debug(f'{item} truncated')
+                yield from held
+                held = []
+                yield line
+    yield from held
+
+
+def write_lines(lines: Iterable[str], fp):
+    """
+    writes lines joined by newlines, without a trailing one
+    :param lines: lines without line endings
+    :param fp: open text file
+    :return: None
+    """
+    for ind, line in enumerate(lines):
+        if ind:
+            fp.write('\n')
+        fp.write(line)
 
 
 if __name__ == '__main__':
-    strip_headers_dir(*argv[1:])
+    strip_headers_dir(*argv[1:3], *[int(arg) for arg in argv[3:4]])
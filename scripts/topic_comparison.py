@@ -0,0 +1,123 @@
+"""
+Topic distance heatmaps of saved models, as an analysis stage separate from training
+
+Every pair of models is diffed once (gensim's LdaModel.diff) and the matrix is cached as
+<output dir>/<model a>__<model b>.<distance>.<num words>.npy, where a model is named by its file
+name and a short hash of its full path so models of the same name in different directories never
+share a file.  A cached matrix is reused until one of its model files is newer than it.  The
+diffs are computed in this process, each model is loaded at most once, and every finished matrix is
+handed to a pool of processes that renders its heatmap (saved under the same name as a .png) in
+the background while the next diff is computed.  A heatmap that is newer than its matrix is not
+rendered again.
+
+    $ python topic_comparison.py <model file> [model file ...]
+"""
+
+
+import hashlib
+import logging
+import os
+import os.path as path
+from concurrent.futures import ProcessPoolExecutor, wait
+from itertools import combinations_with_replacement
+from sys import argv
+
+import numpy as np
+from gensim.models import LdaModel
+
+import instrumentation
+from lda_topic_modeling import topic_difference_heatmap
+
+
+@instrumentation.timed()
+def compare_models(model_paths, output_dir: str = '../outputs/topic_differences',
+                   distance: str = 'jaccard', num_words: int = 50, pairs=None,
+                   workers: int = None):
+    """
+    diffs pairs of saved models and renders a heatmap of each
+    :param model_paths: locations of the saved models
+    :param output_dir: directory for the cached matrices and the heatmaps
+    :param distance: passed to LdaModel.diff
+    :param num_words: passed to LdaModel.diff
+    :param pairs: (optional) list of (model path, model path) tuples to compare, defaults to every
+                  pair of model_paths including each model with itself
+    :param workers: number of rendering processes, defaults to the number of cpus
+    :return: dictionary of (model path, model path) to the location of its heatmap
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if pairs is None:
+        pairs = list(combinations_with_replacement(model_paths, 2))
+    loaded = {}
+    heatmaps = {}
+    pending = set()
+    with ProcessPoolExecutor(workers, initializer=_init_render_worker) as pool:
+        for model_a, model_b in pairs:
+            pair_key = _pair_key(model_a, model_b, distance, num_words)
+            diff_path = path.join(output_dir, f'{pair_key}.npy')
+            if not _is_newer(diff_path, model_a, model_b):
+                for model_path in (model_a, model_b):
+                    if model_path not in loaded:
+                        loaded[model_path] = LdaModel.load(model_path)
+                with instrumentation.stage('topic_diff'):
+                    mdiff, _ = loaded[model_a].diff(loaded[model_b], distance=distance,
+                                                    num_words=num_words)
+                np.save(diff_path + '.tmp.npy', mdiff)
+                os.replace(diff_path + '.tmp.npy', diff_path)
+                instrumentation.count('topic_diffs')
+            heatmaps[model_a, model_b] = path.join(output_dir, f'{pair_key}.png')
+            if not _is_newer(heatmaps[model_a, model_b], diff_path):
+                title = _title(model_a, model_b, distance, num_words)
+                pending.add(pool.submit(render_heatmap, diff_path, title, model_a != model_b,
+                                        output_dir, pair_key))
+        for future in wait(pending).done:
+            future.result()  # re-raises any exception from the worker
+    logging.info(f'{len(pending)} of {len(pairs)} heatmaps rendered in {output_dir}')
+    return heatmaps
+
+
+def render_heatmap(diff_path, title, diff_models, output_dir, file_name):
+    """
+    renders one cached matrix, this is what the pool workers run
+    :param diff_path: location of the cached .npy matrix
+    :param title: title of the plot
+    :param diff_models: see topic_difference_heatmap
+    :param output_dir: directory to save the heatmap to
+    :param file_name: name of the .png without the extension
+    :return: None
+    """
+    topic_difference_heatmap(np.load(diff_path), title, diff_models, output_dir, file_name)
+
+
+def _init_render_worker():
+    # the workers only write files, never open windows
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def _pair_key(model_a, model_b, distance, num_words):
+    return f'{_model_key(model_a)}__{_model_key(model_b)}.{distance}.{num_words}'
+
+
+def _model_key(model_path):
+    path_hash = hashlib.sha1(path.abspath(model_path).encode()).hexdigest()[:8]
+    return f'{_model_name(model_path)}-{path_hash}'
+
+
+def _title(model_a, model_b, distance, num_words):
+    settings = f'({distance}, {num_words} words)'
+    if model_a == model_b:
+        return f'Differences {_model_name(model_a)} {settings}'
+    return f'Comparing {_model_name(model_a)} to {_model_name(model_b)} {settings}'
+
+
+def _model_name(model_path):
+    return path.splitext(path.basename(model_path))[0]
+
+
+def _is_newer(file_path, *sources):
+    return path.isfile(file_path) and \
+        all(path.getmtime(file_path) >= path.getmtime(source) for source in sources)
+
+
+if __name__ == '__main__':
+    compare_models(argv[1:])
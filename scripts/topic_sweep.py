@@ -0,0 +1,207 @@
+"""
+Trains the models of a topic count sweep in parallel
+
+The corpus is written once to a sweep directory as memory mapped CSR arrays which every worker
+process opens without copying.  Each finished model is saved and a row with its wall time,
+perplexity and coherence is appended to summary.csv, a rerun skips every topic count that already
+has a row and a saved model so an interrupted sweep picks up where it left off.  The shared corpus
+is keyed by a hash of its content, sweeping a different corpus in the same directory replaces it
+and sets the old summary aside so every model is trained again.
+
+    $ python topic_sweep.py <streamed corpus directory> [first] [last] [step]
+"""
+
+
+import csv
+import hashlib
+import logging
+import os
+import os.path as path
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sys import argv
+
+import numpy as np
+from gensim.matutils import Sparse2Corpus
+from gensim.models import CoherenceModel
+from scipy import sparse
+
+from lda_topic_modeling import fit_lda
+from streaming_corpus import StreamedCorpus, corpus_to_csr
+
+_SUMMARY = 'summary.csv'
+_SUMMARY_FIELDS = ['num_topics', 'passes', 'wall_seconds', 'log_perplexity', 'perplexity',
+                   'coherence_u_mass', 'model_path']
+_SUMMARY_TYPES = {'num_topics': int, 'passes': int, 'wall_seconds': float, 'log_perplexity': float,
+                  'perplexity': float, 'coherence_u_mass': float, 'model_path': str}
+_CORPUS_ARRAYS = ('indptr', 'indices', 'data')
+_CORPUS_HASH = 'corpus_hash.txt'
+# canonical dtypes the corpus is hashed in so the hash does not depend on how it was built
+_HASH_DTYPES = {'indptr': np.int64, 'indices': np.int64, 'data': np.float64}
+
+
+def run_sweep(corpus, id2word, topic_range=range(10, 50, 5), output_dir='../outputs/sweep',
+              passes=100, workers=None, lda_workers=0):
+    """
+    trains one lda model per topic count across a pool of processes
+    :param corpus: gensim Sparse2Corpus or StreamedCorpus
+    :param id2word: dictionary of term id to word
+    :param topic_range: numbers of topics to try
+    :param output_dir: directory for the shared corpus, the models and the summary table
+    :param passes: training passes per model
+    :param workers: number of models trained at once, defaults to cpus // max(lda_workers, 1)
+    :param lda_workers: passed to fit_lda as multicore, 0 trains each model on a single core
+    :return: list of summary rows (dictionaries) for every model in the sweep
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or max(1, os.cpu_count() // max(lda_workers, 1))
+    share_corpus(corpus, output_dir)
+
+    finished = load_summary(output_dir)
+    to_train = [num_topics for num_topics in topic_range if num_topics not in finished
+                or not path.isfile(finished[num_topics]['model_path'])]
+    logging.info(f'{len(finished)} models already trained, {len(to_train)} to train')
+
+    with ProcessPoolExecutor(min(workers, len(to_train)) or 1) as pool:
+        futures = [pool.submit(train_model, num_topics, output_dir, id2word, passes, lda_workers)
+                   for num_topics in to_train]
+        for future in as_completed(futures):
+            row = future.result()
+            _append_summary(output_dir, row)
+            finished[row['num_topics']] = row
+            logging.info(f'{row["num_topics"]} topics done in {row["wall_seconds"]:.0f}s')
+    return [finished[num_topics] for num_topics in topic_range]
+
+
+def share_corpus(corpus, output_dir):
+    """
+    writes the corpus as .npy CSR components so workers can memory map it.  Skipped if the same
+    corpus is already there, a different one is overwritten and the summary of the models trained
+    on it is renamed to summary_<old corpus hash>.csv
+    :param corpus: gensim Sparse2Corpus or StreamedCorpus
+    :param output_dir: sweep directory
+    :return: None
+    """
+    doc_term = corpus_to_csr(corpus)
+    new_hash = corpus_hash(doc_term)
+    old_hash = shared_corpus_hash(output_dir)
+    if old_hash == new_hash:
+        return
+    summary_path = path.join(output_dir, _SUMMARY)
+    if old_hash is not None and path.isfile(summary_path):
+        logging.info('the corpus changed, models trained on the old one will be trained again')
+        os.replace(summary_path, path.join(output_dir, f'summary_{old_hash[:12]}.csv'))
+    for file_path in (_corpus_path(output_dir, 'shape'), path.join(output_dir, _CORPUS_HASH)):
+        if path.isfile(file_path):
+            os.remove(file_path)
+    for name in _CORPUS_ARRAYS:
+        np.save(_corpus_path(output_dir, name), getattr(doc_term, name))
+    # the shape and the hash are saved last so a partially written corpus is never used
+    np.save(_corpus_path(output_dir, 'shape'), np.array(doc_term.shape))
+    with open(path.join(output_dir, _CORPUS_HASH), 'w') as fp:
+        fp.write(new_hash)
+
+
+def corpus_hash(doc_term):
+    """
+    sha1 of a corpus' shape and CSR components
+    :param doc_term: scipy sparse csr (documents, terms) matrix
+    :return: hex digest
+    """
+    digest = hashlib.sha1(np.array(doc_term.shape, dtype=np.int64).tobytes())
+    for name in _CORPUS_ARRAYS:
+        digest.update(np.ascontiguousarray(getattr(doc_term, name),
+                                           dtype=_HASH_DTYPES[name]).tobytes())
+    return digest.hexdigest()
+
+
+def shared_corpus_hash(output_dir):
+    """
+    the hash of the corpus shared in a sweep directory, computed (and saved) for a directory
+    written before hashes were recorded
+    :param output_dir: sweep directory
+    :return: hex digest or None if there is no complete shared corpus
+    """
+    if not all(path.isfile(_corpus_path(output_dir, name)) for name in _CORPUS_ARRAYS + ('shape',)):
+        return None
+    try:
+        with open(path.join(output_dir, _CORPUS_HASH)) as fp:
+            return fp.read().strip()
+    except FileNotFoundError:
+        stored_hash = corpus_hash(_load_shared_matrix(output_dir))
+    with open(path.join(output_dir, _CORPUS_HASH), 'w') as fp:
+        fp.write(stored_hash)
+    return stored_hash
+
+
+def load_shared_corpus(output_dir):
+    """
+    memory maps the corpus written by share_corpus
+    :param output_dir: sweep directory
+    :return: gensim Sparse2Corpus
+    """
+    return Sparse2Corpus(_load_shared_matrix(output_dir), documents_columns=False)
+
+
+def _load_shared_matrix(output_dir):
+    arrays = [np.load(_corpus_path(output_dir, name), mmap_mode='r') for name in _CORPUS_ARRAYS]
+    shape = tuple(np.load(_corpus_path(output_dir, 'shape')))
+    return sparse.csr_matrix(tuple(reversed(arrays)), shape=shape, copy=False)
+
+
+def train_model(num_topics, output_dir, id2word, passes, lda_workers=0):
+    """
+    trains, scores and saves a single model of the sweep, this is what the pool workers run
+    :param num_topics: number of topics
+    :param output_dir: sweep directory holding the shared corpus
+    :param id2word: dictionary of term id to word
+    :param passes: training passes
+    :param lda_workers: passed to fit_lda as multicore
+    :return: summary row dictionary
+    """
+    corpus = load_shared_corpus(output_dir)
+    start = time.perf_counter()
+    lda = fit_lda(num_topics, corpus, id2word, passes, multicore=lda_workers, save=True,
+                  save_dir=output_dir)
+    wall_seconds = time.perf_counter() - start
+    log_perplexity = float(lda.log_perplexity(corpus))
+    coherence = float(CoherenceModel(model=lda, corpus=corpus, coherence='u_mass').get_coherence())
+    return {'num_topics': num_topics, 'passes': passes, 'wall_seconds': wall_seconds,
+            'log_perplexity': log_perplexity, 'perplexity': 2 ** -log_perplexity,
+            'coherence_u_mass': coherence,
+            'model_path': path.join(output_dir, f'lda_{num_topics}_topics.mdl')}
+
+
+def load_summary(output_dir):
+    """
+    reads the summary table of a sweep
+    :param output_dir: sweep directory
+    :return: dictionary of number of topics to summary row
+    """
+    try:
+        with open(path.join(output_dir, _SUMMARY), newline='') as fp:
+            rows = list(csv.DictReader(fp))
+    except FileNotFoundError:
+        return {}
+    # csv hands back strings, the rows are converted back to the types a new row has
+    rows = [{field: _SUMMARY_TYPES[field](value) for field, value in row.items()} for row in rows]
+    return {row['num_topics']: row for row in rows}
+
+
+def _append_summary(output_dir, row):
+    summary_path = path.join(output_dir, _SUMMARY)
+    new_file = not path.isfile(summary_path)
+    with open(summary_path, 'a', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=_SUMMARY_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def _corpus_path(output_dir, name):
+    return path.join(output_dir, f'corpus_{name}.npy')
+
+
+if __name__ == '__main__':
+    streamed = StreamedCorpus(argv[1])
+    run_sweep(streamed, streamed.id2word(), range(*[int(arg) for arg in argv[2:]] or (10, 50, 5)))
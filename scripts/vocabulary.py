@@ -0,0 +1,200 @@
+"""
+Vocabulary pruning before lda
+
+fit_vectorizer keeps every word that is not a stop word, so the vocabulary (and the cost of every
+training pass) keeps growing with the corpus.  This stage
+ 1. counts every term's document frequency and total count in one pass over the vectorized corpus
+    (one CSR chunk at a time for a StreamedCorpus)
+ 2. keeps the terms inside document frequency bounds, optionally capped to the most frequent
+    max_features
+ 3. saves the kept words as a dictionary that can be applied to any corpus by word
+
+    $ python vocabulary.py <streamed corpus dir> <dictionary .json> [min df] [max df] [max features]
+    $ python vocabulary.py report <streamed corpus dir> [vocabulary size ...]
+
+The report trains a model per vocabulary size and shows the training time, the topic coherence and
+how many of each book's recommendations agree with the largest vocabulary's.
+"""
+
+
+import json
+import logging
+import time
+from sys import argv
+
+import numpy as np
+from gensim.matutils import Sparse2Corpus
+from gensim.models import CoherenceModel
+
+from neighbours import exact_neighbours, normalize_rows
+from streaming_corpus import StreamedCorpus, corpus_to_csr
+
+_VOCAB_SIZES = (None, 50000, 20000, 10000, 5000)  # None keeps every term within the df bounds
+
+
+def term_statistics(corpus):
+    """
+    one pass over the corpus counting how many documents every term appears in and how often it
+    appears overall
+    :param corpus: gensim Sparse2Corpus or StreamedCorpus
+    :return: document frequency array, collection frequency array, number of documents
+    """
+    chunks = corpus.iter_chunks() if isinstance(corpus, StreamedCorpus) else [corpus_to_csr(corpus)]
+    doc_freq = collection_freq = None
+    num_docs = 0
+    for chunk in chunks:
+        if doc_freq is None:
+            doc_freq = np.zeros(chunk.shape[1], dtype=np.int64)
+            collection_freq = np.zeros(chunk.shape[1], dtype=np.float64)
+        doc_freq += np.bincount(chunk.indices, minlength=chunk.shape[1])
+        collection_freq += np.bincount(chunk.indices, weights=chunk.data, minlength=chunk.shape[1])
+        num_docs += chunk.shape[0]
+    return doc_freq, collection_freq, num_docs
+
+
+def select_terms(doc_freq, collection_freq, num_docs, min_df=5, max_df=.5, max_features=None):
+    """
+    picks the terms to keep, the bounds work like CountVectorizer's
+    :param doc_freq: document frequency of every term
+    :param collection_freq: total count of every term
+    :param num_docs: number of documents
+    :param min_df: terms in fewer documents are dropped, a float is a fraction of the documents
+    :param max_df: terms in more documents are dropped, a float is a fraction of the documents
+    :param max_features: (optional) keep only this many terms, the most frequent overall
+    :return: sorted array of the kept term ids
+    """
+    min_count = min_df * num_docs if isinstance(min_df, float) else min_df
+    max_count = max_df * num_docs if isinstance(max_df, float) else max_df
+    keep = np.flatnonzero((doc_freq >= min_count) & (doc_freq <= max_count))
+    if max_features is not None and len(keep) > max_features:
+        most_frequent = np.argsort(-collection_freq[keep], kind='stable')[:max_features]
+        keep = np.sort(keep[most_frequent])
+    return keep
+
+
+def build_dictionary(corpus, id2word: dict, output_path: str = None, min_df=5, max_df=.5,
+                     max_features: int = None):
+    """
+    prunes the vocabulary of a corpus and optionally saves it
+    :param corpus: gensim Sparse2Corpus or StreamedCorpus
+    :param id2word: dictionary of term id to word of the corpus
+    :param output_path: (optional) .json file to save the dictionary to
+    :param min_df: see select_terms
+    :param max_df: see select_terms
+    :param max_features: see select_terms
+    :return: dictionary with the kept words, their document and collection frequencies, and the
+             settings and statistics they were chosen with
+    """
+    doc_freq, collection_freq, num_docs = term_statistics(corpus)
+    keep = select_terms(doc_freq, collection_freq, num_docs, min_df, max_df, max_features)
+    keep = [term for term in keep.tolist() if term in id2word]
+    dictionary = {'words': [id2word[term] for term in keep],
+                  'doc_freq': doc_freq[keep].tolist(),
+                  'collection_freq': collection_freq[keep].tolist(),
+                  'num_docs': num_docs, 'original_terms': len(doc_freq),
+                  'min_df': min_df, 'max_df': max_df, 'max_features': max_features}
+    logging.info(f'vocabulary pruned from {len(doc_freq)} to {len(keep)} terms')
+    if output_path:
+        save_dictionary(output_path, dictionary)
+    return dictionary
+
+
+def save_dictionary(file_path: str, dictionary: dict):
+    with open(file_path, 'w') as fp:
+        json.dump(dictionary, fp)
+
+
+def load_dictionary(file_path: str):
+    with open(file_path) as fp:
+        return json.load(fp)
+
+
+def apply_dictionary(corpus, id2word: dict, dictionary: dict, output_dir: str = None):
+    """
+    restricts a corpus to the words of a dictionary, the terms are renumbered in dictionary order
+    and words the corpus does not have are left out
+    :param corpus: gensim Sparse2Corpus or StreamedCorpus
+    :param id2word: dictionary of term id to word of the corpus
+    :param dictionary: output of build_dictionary / load_dictionary
+    :param output_dir: directory for the pruned corpus, required for a StreamedCorpus
+    :return: pruned corpus of the same type, its id2word
+    """
+    word2id = {word: term for term, word in id2word.items()}
+    columns = [word2id[word] for word in dictionary['words'] if word in word2id]
+    new_id2word = {new: id2word[old] for new, old in enumerate(columns)}
+    if isinstance(corpus, StreamedCorpus):
+        if output_dir is None:
+            raise ValueError('output_dir is needed to prune a StreamedCorpus')
+        return corpus.select_terms(columns, output_dir), new_id2word
+    doc_term = corpus_to_csr(corpus)[:, columns]
+    return Sparse2Corpus(doc_term, documents_columns=False), new_id2word
+
+
+def vocabulary_report(corpus, id2word: dict, vocab_sizes=_VOCAB_SIZES,
+                      num_topics: int = 30, passes: int = 10, min_df=5, max_df=.5, k: int = 10,
+                      sample_size: int = 500, seed: int = 0):
+    """
+    trains a model for every vocabulary size and prints how the size affects training time and
+    recommendation quality.  Quality is the topic coherence and recall@k: the share of each sampled
+    book's k recommendations that the first (largest) vocabulary's model also recommends.  Lda is
+    not deterministic so recall@k stays below 1 even for two models of the same vocabulary
+    :param corpus: gensim Sparse2Corpus, a StreamedCorpus should be loaded with to_csr first
+    :param id2word: dictionary of term id to word of the corpus
+    :param vocab_sizes: max_features values to try, None keeps every term within the df bounds
+    :param num_topics: topics of every model
+    :param passes: training passes of every model
+    :param min_df: see select_terms
+    :param max_df: see select_terms
+    :param k: number of recommendations compared
+    :param sample_size: number of books whose recommendations are compared
+    :param seed: seed for choosing the sampled books
+    :return: list of result dictionaries, one per vocabulary size
+    """
+    # imported here, lda_topic_modeling imports this module
+    from lda_topic_modeling import fit_lda
+    from recommender import build_doc_topics
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(corpus), min(sample_size, len(corpus)), replace=False)
+    baseline = None
+    results = []
+    for max_features in vocab_sizes:
+        dictionary = build_dictionary(corpus, id2word, None, min_df, max_df, max_features)
+        pruned, pruned_id2word = apply_dictionary(corpus, id2word, dictionary)
+        start = time.perf_counter()
+        model = fit_lda(num_topics, pruned, pruned_id2word, passes, save=False)
+        train_seconds = time.perf_counter() - start
+        coherence = CoherenceModel(model=model, corpus=pruned, coherence='u_mass').get_coherence()
+        doc_topics = normalize_rows(build_doc_topics(model, pruned))
+        recs = [set(exact_neighbours(doc_topics[ind], doc_topics, k, exclude=[ind]).tolist())
+                for ind in sample]
+        baseline = baseline or recs
+        recall = np.mean([len(rec & base) / k for rec, base in zip(recs, baseline)])
+        results.append({'max_features': max_features, 'terms': len(dictionary['words']),
+                        'nonzeros': int(pruned.sparse.nnz), 'train_seconds': train_seconds,
+                        'coherence_u_mass': float(coherence), f'recall@{k}': float(recall)})
+    print_vocabulary_report(results, k)
+    return results
+
+
+def print_vocabulary_report(results, k=10):
+    format_str = '{:>12} | {:>8} | {:>12} | {:>10} | {:>10} | {:>10}'
+    print(format_str.format('max features', 'terms', 'nonzeros', 'train s', 'u_mass',
+                            f'recall@{k}'))
+    print('—' * 77)
+    for row in results:
+        print(format_str.format(str(row['max_features']), row['terms'], row['nonzeros'],
+                                f'{row["train_seconds"]:.1f}', f'{row["coherence_u_mass"]:.3f}',
+                                f'{row[f"recall@{k}"]:.3f}'))
+
+
+if __name__ == '__main__':
+    if argv[1] == 'report':
+        streamed = StreamedCorpus(argv[2])
+        in_memory = Sparse2Corpus(streamed.to_csr(), documents_columns=False)
+        sizes = [None] + [int(arg) for arg in argv[3:]]
+        vocabulary_report(in_memory, streamed.id2word(), sizes if argv[3:] else _VOCAB_SIZES)
+    else:
+        streamed = StreamedCorpus(argv[1])
+        bounds = [float(arg) if '.' in arg else int(arg) for arg in argv[3:]]
+        build_dictionary(streamed, streamed.id2word(), argv[2], *bounds)
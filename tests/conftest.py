@@ -0,0 +1,5 @@
+import os.path as path
+import sys
+
+# the scripts import each other as top level modules
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'scripts'))
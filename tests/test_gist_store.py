@@ -0,0 +1,30 @@
+from collections import Counter
+
+import numpy as np
+
+from gist_store import GistStore
+from lda_topic_modeling import convert_corpus, fit_vectorizer
+from streaming_corpus import corpus_to_csr
+
+_GISTS = {'11': "the whale the whale ahab ahab ahab sea n't don't 's",
+          '84': 'monster creature victor victor the and elizabeth x-ray',
+          '1342': "darcy darcy elizabeth bennet o'clock the the pride",
+          '2701': 'sea sea sea whale ishmael queequeg rock\'n\'roll',
+          '98': 'a i of to city paris london guillotine'}
+
+
+def test_to_corpus_matches_vectorizer(tmp_path):
+    with GistStore(str(tmp_path), segment_size=2) as store:
+        for title, gist in list(_GISTS.items())[:3]:
+            store.add(title, Counter(gist.split()))
+    with GistStore(str(tmp_path), segment_size=2) as store:  # reopened stores append
+        for title, gist in list(_GISTS.items())[3:]:
+            store.add(title, Counter(gist.split()))
+    corpus, id2word, titles = GistStore(str(tmp_path)).to_corpus()
+
+    assert titles == list(_GISTS)
+    texts = [_GISTS[title] for title in titles]
+    expected_corpus, expected_id2word = convert_corpus(texts, fit_vectorizer(texts))
+    assert id2word == expected_id2word
+    np.testing.assert_array_equal(corpus_to_csr(corpus).toarray(),
+                                  corpus_to_csr(expected_corpus).toarray())
@@ -0,0 +1,14 @@
+import numpy as np
+
+from metadata_index import MetadataIndex, build_metadata_index
+
+
+def test_lookup_accepts_numpy_ids(tmp_path):
+    db_path = str(tmp_path / 'metadata.sqlite')
+    build_metadata_index([(np.int64(174), 'The Picture of Dorian Gray', 'Wilde, Oscar', 'en',
+                           ['Fiction']), (11, 'Alice', 'Carroll, Lewis', 'en', [])], db_path)
+    index = MetadataIndex(db_path)
+    found = index.lookup(np.array([174, 11, 5], dtype=np.int64))
+    index.close()
+    assert found == {174: ('The Picture of Dorian Gray', 'Wilde, Oscar', 'en', ['Fiction']),
+                     11: ('Alice', 'Carroll, Lewis', 'en', [])}
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from neighbours import normalize_rows, profile_vector, top_k, top_k_rows
+
+
+def _doc_topics(num_docs=50, num_topics=8, seed=0):
+    return normalize_rows(np.random.default_rng(seed).random((num_docs, num_topics)))
+
+
+def test_profile_vector_zero_weights_fall_back_to_mean():
+    doc_topics = _doc_topics()
+    np.testing.assert_allclose(profile_vector(doc_topics, [1, 2, 3], [0, 0, 0]),
+                               profile_vector(doc_topics, [1, 2, 3]))
+
+
+def test_profile_vector_rejects_bad_weights():
+    doc_topics = _doc_topics()
+    with pytest.raises(ValueError):
+        profile_vector(doc_topics, [1, 2, 3], [1, 2])
+    with pytest.raises(ValueError):
+        profile_vector(doc_topics, [1, 2], [1, -1])
+
+
+def test_top_k_rows_matches_top_k():
+    scores = _doc_topics()[:10] @ _doc_topics().T
+    exclude = np.arange(10)
+    rec_ind, rec_scores = top_k_rows(scores.copy(), 5, exclude=exclude)
+    for row in range(10):
+        np.testing.assert_array_equal(rec_ind[row], top_k(scores[row].copy(), 5, [row]))
+        np.testing.assert_allclose(rec_scores[row], scores[row, rec_ind[row]])
+
+
+@pytest.mark.parametrize('k, expected', [(0, 0), (-3, 0), (49, 49), (50, 49), (80, 49)])
+def test_top_k_rows_clamps_k(k, expected):
+    scores = _doc_topics()[:4] @ _doc_topics().T
+    rec_ind, rec_scores = top_k_rows(scores, k, exclude=np.arange(4))
+    assert rec_ind.shape == rec_scores.shape == (4, expected)
+    assert all(row not in rec_ind[row] for row in range(4))
@@ -0,0 +1,47 @@
+import random
+
+import nltk
+import pytest
+
+import pre_processing
+from pre_processing import fast_pre_processing, gist_pre_processing
+
+_SAMPLES = ["Don't stop--it's 3 o'clock, isn't it?  \"Yes,\" she said.",
+            "I cannot go; we're gonna wanna lemme gimme gotta  'quoted' words.",
+            "«Bonjour» “smart” ‘quotes’ „low“ em—dash en–dash figure‒dash",
+            'snake_case a2b 42nd x-ray ma\'am rock\'n\'roll o\'neill \'tis dogs\' ',
+            'Tabs\tand\nnewlines\n\nCAPITALS Ünïcödé naïve café 1999s']
+# characters the cleaning and splitting rules care about, weighted towards letters
+_ALPHABET = "abcdeftnoi' \"\n-—–‒«»“”‘’„.,;:!?_0123456789"
+
+
+@pytest.fixture(autouse=True)
+def sentence_free_tokenizer(monkeypatch):
+    # word_tokenize sentence splits first, which needs the punkt model.  The punctuation is already
+    # removed by then, so tokenizing each line as one sentence gives the same tokens
+    try:
+        nltk.data.find('tokenizers/punkt_tab')
+    except LookupError:
+        monkeypatch.setattr(pre_processing, 'word_tokenize',
+                            lambda text: nltk.word_tokenize(text, preserve_line=True))
+
+
+@pytest.mark.parametrize('document', _SAMPLES)
+def test_fast_pre_processing_matches_word_tokenize(document):
+    assert fast_pre_processing(document) == gist_pre_processing(document)
+
+
+def test_fast_pre_processing_matches_word_tokenize_on_random_text():
+    rng = random.Random(0)
+    words = ["can't", 'cannot', "'em", 'gonna', "o'", "''", 'the', 'x1']
+    for _ in range(500):
+        document = ''.join(rng.choice(_ALPHABET) if rng.random() < .8 else rng.choice(words)
+                           for _ in range(rng.randint(1, 60)))
+        assert fast_pre_processing(document) == gist_pre_processing(document), document
+
+
+def test_iter_corpus_files_skips_temp_files(tmp_path):
+    for name in ('12.txt', '12.txt.tmp', '.13.txt.tmp', '14.txt.tmp'):
+        (tmp_path / name).write_text('some words')
+    (tmp_path / 'gists').mkdir()
+    assert [title for title, _ in pre_processing.iter_corpus_files(str(tmp_path))] == ['12']
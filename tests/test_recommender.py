@@ -0,0 +1,52 @@
+import numpy as np
+from gensim.matutils import Sparse2Corpus
+from gensim.models import LdaModel
+from scipy import sparse
+from sklearn.metrics import pairwise_distances
+
+from neighbours import normalize_rows
+from recommender import build_doc_topics, similar_ids, topic_weights_to_matrix
+
+
+def _model_and_corpus(num_docs=300, num_terms=200, num_topics=8):
+    doc_term = sparse.random(num_docs, num_terms, density=.05, format='csr', random_state=0)
+    doc_term.data = np.ceil(doc_term.data * 5)
+    corpus = Sparse2Corpus(doc_term, documents_columns=False)
+    id2word = {ind: str(ind) for ind in range(num_terms)}
+    model = LdaModel(corpus, num_topics=num_topics, id2word=id2word, random_state=0)
+    return model, corpus
+
+
+def test_topic_weights_to_matrix_matches_loop():
+    topic_weights = [[(0, .5), (2, .5)], [], [(1, 1.)]]
+    expected = np.zeros((3, 4), dtype=np.float32)
+    for ind, doc in enumerate(topic_weights):
+        for topic, weight in doc:
+            expected[ind, topic] = weight
+    np.testing.assert_array_equal(topic_weights_to_matrix(topic_weights, 4), expected)
+    out = np.zeros((5, 4), dtype=np.float32)
+    filled = topic_weights_to_matrix(topic_weights, out=out[1:])
+    assert np.shares_memory(filled, out)
+    np.testing.assert_array_equal(out[1:4], expected)
+    assert not out[[0, 4]].any()
+
+
+def test_build_doc_topics_independent_of_workers():
+    model, corpus = _model_and_corpus()
+    serial = build_doc_topics(model, corpus, workers=1, chunksize=64)
+    parallel = build_doc_topics(model, corpus, workers=2, chunksize=64)
+    np.testing.assert_allclose(serial, parallel, atol=1e-6)
+    np.testing.assert_allclose(serial, build_doc_topics(model, corpus, workers=1, chunksize=64))
+
+
+def test_similar_ids_matches_distance_matrix_up_to_ties():
+    doc_topics = np.random.default_rng(0).random((200, 8))
+    doc_topics[100:150] = doc_topics[:50]  # duplicated books tie with each other
+    distance_mat = pairwise_distances(doc_topics, metric='cosine')
+    normalized = normalize_rows(doc_topics)
+    for ind in range(0, 200, 7):
+        rec_ind = similar_ids(ind, normalized, 10)
+        assert ind not in rec_ind
+        # the old argsort put the query (distance 0) first, ties may come out in either order
+        expected = np.sort(np.delete(distance_mat[ind], ind))[:10]
+        np.testing.assert_allclose(distance_mat[ind, rec_ind], expected, atol=1e-6)
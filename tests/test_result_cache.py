@@ -0,0 +1,46 @@
+import threading
+
+import numpy as np
+
+from result_cache import RecommendationCache
+
+
+def test_lru_eviction():
+    cache = RecommendationCache('v1', max_size=2)
+    cache.put(1, 5, [2, 3])
+    cache.put(2, 5, [1, 3])
+    cache.get(1, 5)
+    cache.put(3, 5, [1, 2])
+    assert cache.get(2, 5) is None
+    assert cache.get(1, 5) == [2, 3]
+    assert cache.stats()['size'] == 2
+
+
+def test_results_survive_reopening(tmp_path):
+    db_path = str(tmp_path / 'cache.sqlite')
+    cache = RecommendationCache('v1', db_path=db_path)
+    for book_id in range(100):  # more than one write batch
+        cache.put(np.int64(book_id), 5, np.arange(5) + book_id)
+    cache.close()
+    reopened = RecommendationCache('v1', max_size=10, db_path=db_path)
+    assert all(reopened.get(book_id, 5) == list(range(book_id, book_id + 5))
+               for book_id in range(100))
+    reopened.close()
+    assert RecommendationCache('v2', db_path=db_path).get(1, 5) is None
+
+
+def test_concurrent_use(tmp_path):
+    cache = RecommendationCache('v1', max_size=50, db_path=str(tmp_path / 'cache.sqlite'))
+
+    def worker(offset):
+        for book_id in range(offset, offset + 200):
+            if cache.get(book_id % 120, 5) is None:
+                cache.put(book_id % 120, 5, [book_id % 120])
+
+    threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(0, 800, 100)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cache.close()
+    assert cache.stats()['hits'] + cache.stats()['misses'] == 1600
@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from strip_headers import (_LEGALESE_END_MARKERS, _LEGALESE_START_MARKERS, _TEXT_END_MARKERS,
+                           _TEXT_START_MARKERS, strip_lines)
+
+
+def _library_strip_headers(text):
+    # gutenberg.cleanup.strip_headers (gutenberg 0.8) with its posix line separator, which works on
+    # the whole book at once
+    out = []
+    i = 0
+    ignore_section = False
+    for line in text.splitlines():
+        if i <= 600 and any(line.startswith(token) for token in _TEXT_START_MARKERS):
+            out = []
+            continue
+        if i >= 100 and any(line.startswith(token) for token in _TEXT_END_MARKERS):
+            break
+        if any(line.startswith(token) for token in _LEGALESE_START_MARKERS):
+            ignore_section = True
+            continue
+        elif any(line.startswith(token) for token in _LEGALESE_END_MARKERS):
+            ignore_section = False
+            continue
+        if not ignore_section:
+            out.append(line.rstrip('\n'))
+            i += 1
+    return '\n'.join(out)
+
+
+def _random_book(rng):
+    markers = [_TEXT_START_MARKERS, _TEXT_END_MARKERS, _LEGALESE_START_MARKERS,
+               _LEGALESE_END_MARKERS]
+    lines = []
+    for _ in range(rng.randint(0, 12)):
+        if rng.random() < .6:
+            # long enough blocks to cross the 100 and 600 line limits
+            lines += [f'line {len(lines)}' if rng.random() < .9 else ''
+                      for _ in range(rng.choice([1, 5, 50, 99, 100, 101, 300, 600]))]
+        else:
+            lines.append(rng.choice(rng.choice(markers)) + ' some title')
+    return '\n'.join(lines) + rng.choice(['', '\n'])
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_strip_lines_matches_library(seed):
+    text = _random_book(random.Random(seed))
+    expected = _library_strip_headers(text)
+    assert '\n'.join(strip_lines(text.splitlines(keepends=True))) == expected
+    assert '\n'.join(strip_lines([text])) == expected
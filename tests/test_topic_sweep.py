@@ -0,0 +1,35 @@
+from gensim.matutils import Sparse2Corpus
+from scipy import sparse
+
+from topic_sweep import _append_summary, load_shared_corpus, load_summary, share_corpus
+
+
+def _corpus(seed):
+    doc_term = sparse.random(20, 30, density=.2, format='csr', random_state=seed)
+    return Sparse2Corpus(doc_term, documents_columns=False)
+
+
+_ROW = {'num_topics': 5, 'passes': 10, 'wall_seconds': 1.5, 'log_perplexity': -7.25,
+        'perplexity': 152.2, 'coherence_u_mass': -1.125, 'model_path': 'lda_5_topics.mdl'}
+
+
+def test_resumed_summary_keeps_types(tmp_path):
+    _append_summary(str(tmp_path), _ROW)
+    assert load_summary(str(tmp_path)) == {5: _ROW}
+
+
+def test_changed_corpus_is_shared_again(tmp_path):
+    output_dir = str(tmp_path)
+    share_corpus(_corpus(0), output_dir)
+    _append_summary(output_dir, _ROW)
+    share_corpus(_corpus(0), output_dir)
+    assert load_summary(output_dir).keys() == {5}
+    (tmp_path / 'corpus_hash.txt').unlink()  # a sweep directory from before hashes were saved
+    share_corpus(_corpus(0), output_dir)
+    assert load_summary(output_dir).keys() == {5}
+
+    new_corpus = _corpus(1)
+    share_corpus(new_corpus, output_dir)
+    assert (load_shared_corpus(output_dir).sparse != new_corpus.sparse).nnz == 0
+    assert load_summary(output_dir) == {}
+    assert len(list(tmp_path.glob('summary_*.csv'))) == 1